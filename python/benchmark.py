@@ -0,0 +1,325 @@
+"""Benchmarks process snapshot collection paths at several scales.
+
+Each case is a sequence of stages run in a fresh child process, so that
+peak RSS and psutil caches are not shared between cases. Scales are either
+"live" (the real /proc) or "<num_procs>x<threads_per_proc>", for which a
+synthetic tree is generated with procfs_fixture. "ps"-based cases can only
+run on the live system.
+
+Usage:
+    python benchmark.py --scales live,1000x4,30000x6.7 --save-baseline base.json
+    python benchmark.py --scales live,1000x4,30000x6.7 --baseline base.json
+"""
+
+import os
+import sys
+import time
+import json
+import resource
+import tempfile
+import argparse
+import contextlib
+import multiprocessing
+
+import psutil
+import numpy as np
+import pandas as pd
+
+import utils
+import procfs
+import psutil_funcs
+import procsnapshot
+import procfs_fixture
+
+
+FIXTURE_DIR = os.path.join(tempfile.gettempdir(), f'svadmin-bench-fixtures-{os.getuid()}')
+RESULT_COLUMNS = ['case', 'scale', 'stage', 'wall_sec', 'cpu_sec', 'peak_rss_mb']
+COMPARED_METRICS = ['wall_sec', 'cpu_sec', 'peak_rss_mb']
+
+
+def argument_parsing():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--scales',
+        help=f'Comma-separated scales; "live" or "<num_procs>x<threads_per_proc>"',
+        default='live,1000x4',
+        type=(lambda x: x.split(',')),
+        dest='scales',
+    )
+    parser.add_argument(
+        '--cases',
+        help=f'Comma-separated case names. Default: all of {",".join(CASES.keys())}',
+        default=None,
+        type=(lambda x: x.split(',')),
+        dest='cases',
+    )
+    parser.add_argument(
+        '--repeat',
+        help=f'Each case is run this many times and the median of each metric is reported',
+        default=3,
+        type=int,
+        dest='repeat',
+    )
+    parser.add_argument(
+        '--baseline',
+        help=f'Json file written with --save-baseline. If given, exits with status 1 on regression.',
+        default=None,
+        dest='baseline',
+    )
+    parser.add_argument(
+        '--tolerance',
+        help=f'Allowed fractional increase over the baseline',
+        default=0.25,
+        type=float,
+        dest='tolerance',
+    )
+    parser.add_argument(
+        '--min-delta-sec',
+        help=f'Time increases smaller than this are not regressions, regardless of tolerance',
+        default=0.02,
+        type=float,
+        dest='min_delta_sec',
+    )
+    parser.add_argument(
+        '--save-baseline',
+        help=f'If given, results are written to this json file.',
+        default=None,
+        dest='save_baseline',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+#########
+# cases #
+#########
+
+# A case is a list of (stage name, function). Each function takes a dict
+# shared by the stages of one run and stores its products in it.
+
+def stage_enumerate(state):
+    state['procs'] = list(psutil.process_iter())
+
+
+def stage_snapshot_attrs(state):
+    attrs = ['cmdline', 'pid', 'username', ('memory_full_info' if utils.check_root() else 'memory_info')]
+    for proc in state['procs']:
+        try:
+            proc.info = proc.as_dict(attrs=attrs)
+        except psutil.NoSuchProcess:
+            proc.info = dict((x, None) for x in attrs)
+    snapshot = procsnapshot.ProcessSnapshot()
+    snapshot.psutil_procs = state['procs']
+    snapshot.set_basic_columns()
+    state['snapshot'] = snapshot
+
+
+def stage_snapshot_thread_states(state):
+    state['snapshot'].add_thread_states()
+
+
+def stage_snapshot_rates(state):
+    # two readings without sleeping in between; rates themselves are meaningless
+    with np.errstate(divide='ignore', invalid='ignore'):
+        state['snapshot'].add_pcpu_io_with_psutil(pcpu=True, IO=True, interval=0)
+
+
+def stage_snapshot_dataframe(state):
+    state['snapshot'].set_df()
+
+
+def stage_mem_attrs(state):
+    state['procs'] = list(psutil.process_iter(attrs=psutil_funcs.MEM_DF_ATTRS))
+
+
+def stage_mem_dataframe(state):
+    state['df'] = psutil_funcs.make_rss_df(state['procs'])
+
+
+def stage_mem_smaps(state):
+    df = state['df']
+    top_users = df.groupby('user')['rss_bytes'].sum().nlargest(3).index
+    psutil_funcs.add_smaps_rollup(df, df['user'].isin(top_users).to_numpy())
+
+
+CASES = {
+    'procsnapshot_psutil': [
+        ('enumerate', stage_enumerate),
+        ('attrs', stage_snapshot_attrs),
+        ('thread_states', stage_snapshot_thread_states),
+        ('rates', stage_snapshot_rates),
+        ('dataframe', stage_snapshot_dataframe),
+    ],
+    'byuser_mem_tiered': [
+        ('attrs', stage_mem_attrs),
+        ('dataframe', stage_mem_dataframe),
+        ('smaps', stage_mem_smaps),
+    ],
+    'byuser_mem_full': [
+        ('all', (lambda state: psutil_funcs.get_byuser_mem(tiered=False))),
+    ],
+    'proc_df_procfs': [
+        ('all', (lambda state: procfs.read_proc_df(include_threads=True, proc_root=state['proc_root']))),
+    ],
+    'ps_pandas': [
+        ('all', (lambda state: utils.run_ps_read_with_pandas(include_threads=True))),
+    ],
+    'ps_linedict': [
+        ('all', (lambda state: utils.get_proc_snapshot_ps())),
+    ],
+}
+LIVE_ONLY_CASES = ('ps_pandas', 'ps_linedict')
+
+
+##########
+# runner #
+##########
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextlib.contextmanager
+def using_proc_root(proc_root):
+    """Within this context, psutil and the procfs readers called from 
+    psutil_funcs read "proc_root" instead of /proc.
+
+    psutil.PROCFS_PATH is process-global: every thread reads the replaced
+    root, and Process objects cached by psutil.process_iter outlive the 
+    context. Use only in a throwaway process, as "run_stages" does.
+    """
+    original = psutil.PROCFS_PATH
+    psutil.PROCFS_PATH = proc_root
+    try:
+        yield
+    finally:
+        psutil.PROCFS_PATH = original
+
+
+def run_stages(case, proc_root):
+    """Runs in a child process. "peak_rss_mb" is the high-water mark of the
+    process up to the end of each stage.
+    """
+    state = {'proc_root': proc_root}
+    results = list()
+    with using_proc_root(proc_root):
+        for stage, func in CASES[case]:
+            wall0 = time.perf_counter()
+            cpu0 = time.process_time()
+            func(state)
+            results.append(
+                {
+                    'stage': stage,
+                    'wall_sec': time.perf_counter() - wall0,
+                    'cpu_sec': time.process_time() - cpu0,
+                    'peak_rss_mb': get_peak_rss_mb(),
+                }
+            )
+    return results
+
+
+def get_proc_root(scale, seed=0):
+    if scale == 'live':
+        return procfs.PROC_ROOT
+
+    num_procs, threads_per_proc = scale.split('x')
+    proc_root = os.path.join(FIXTURE_DIR, f'{scale}-seed{seed}')
+    if not os.path.exists(proc_root):
+        print(f'Generating a fixture with scale {scale} at {repr(proc_root)}', file=sys.stderr)
+        procfs_fixture.generate(
+            proc_root,
+            num_procs=int(num_procs),
+            threads_per_proc=float(threads_per_proc),
+            seed=seed,
+        )
+    return proc_root
+
+
+def run_benchmark(scales, cases=None, repeat=3):
+    """Returns a DataFrame with columns RESULT_COLUMNS, with the median of
+    "repeat" runs.
+    """
+    if cases is None:
+        cases = list(CASES.keys())
+    context = multiprocessing.get_context('fork')
+
+    rows = list()
+    for scale in scales:
+        proc_root = get_proc_root(scale)
+        for case in cases:
+            if (scale != 'live') and (case in LIVE_ONLY_CASES):
+                continue
+            runs = list()
+            for _ in range(repeat):
+                with context.Pool(processes=1, maxtasksperchild=1) as pool:
+                    runs.append(pool.apply(run_stages, (case, proc_root)))
+            for stage_idx, (stage, _) in enumerate(CASES[case]):
+                row = {'case': case, 'scale': scale, 'stage': stage}
+                for key in COMPARED_METRICS:
+                    row[key] = np.median([x[stage_idx][key] for x in runs])
+                rows.append(row)
+
+    return pd.DataFrame.from_records(rows, columns=RESULT_COLUMNS)
+
+
+def compare_with_baseline(result_df, baseline_df, tolerance=0.25, min_delta_sec=0.02):
+    """Returns a DataFrame of regressions, one row for each metric exceeding
+    the baseline by more than "tolerance" (and by more than "min_delta_sec"
+    for times). Stages missing from the baseline are not compared.
+    """
+    keys = ['case', 'scale', 'stage']
+    merged = result_df.merge(baseline_df, on=keys, how='inner', suffixes=('', '_baseline'))
+    regressions = list()
+    for key in COMPARED_METRICS:
+        current = merged[key]
+        baseline = merged[f'{key}_baseline']
+        exceeded = current > baseline * (1 + tolerance)
+        if key.endswith('_sec'):
+            exceeded &= (current - baseline) > min_delta_sec
+        for _, row in merged.loc[exceeded, :].iterrows():
+            regressions.append(
+                {
+                    'case': row['case'],
+                    'scale': row['scale'],
+                    'stage': row['stage'],
+                    'metric': key,
+                    'baseline': row[f'{key}_baseline'],
+                    'current': row[key],
+                }
+            )
+    return pd.DataFrame.from_records(
+        regressions, columns=(keys + ['metric', 'baseline', 'current']),
+    )
+
+
+def main():
+    args = argument_parsing()
+    result_df = run_benchmark(args.scales, cases=args.cases, repeat=args.repeat)
+    with pd.option_context('display.max_rows', None, 'display.width', None):
+        print(result_df)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'wt') as f:
+            json.dump(result_df.to_dict(orient='records'), f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline_df = pd.DataFrame.from_records(json.load(f))
+        regressions = compare_with_baseline(
+            result_df, baseline_df, tolerance=args.tolerance, min_delta_sec=args.min_delta_sec,
+        )
+        if regressions.shape[0] > 0:
+            print()
+            print(f'Regressions against {repr(args.baseline)}:')
+            with pd.option_context('display.max_rows', None, 'display.width', None):
+                print(regressions)
+            sys.exit(1)
+        else:
+            print()
+            print(f'No regressions against {repr(args.baseline)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Per-user resource usage read from systemd user slices of cgroup v2.
+
+Each login user has "user.slice/user-<uid>.slice", whose counters already
+cover every process of that user. Reading them costs O(users) instead of
+O(processes). "cgroup_root" may point to a fixture directory with the same
+layout.
+"""
+
+import os
+import re
+import pwd
+import time
+
+import numpy as np
+import pandas as pd
+
+import procfs
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+USER_SLICE_DIR = 'user.slice'
+USER_SLICE_PAT = re.compile(r'^user-([0-9]+)\.slice$')
+
+USAGE_DF_COLUMNS = (
+    'uid',
+    'user',
+    'cpu_usec',
+    'memory_bytes',
+    'anon_bytes',
+    'read_bytes',
+    'write_bytes',
+)
+
+
+###########
+# readers #
+###########
+
+def read_text(path):
+    """Returns None if the file does not exist, e.g. a slice was just removed
+    or a controller is not enabled.
+    """
+    try:
+        with open(path) as f:
+            return f.read()
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+def list_user_slices(cgroup_root=CGROUP_ROOT):
+    """Returns a dict mapping uid to the path of its user slice"""
+    topdir = os.path.join(cgroup_root, USER_SLICE_DIR)
+    try:
+        names = os.listdir(topdir)
+    except FileNotFoundError:
+        return dict()
+
+    result = dict()
+    for name in names:
+        mat = USER_SLICE_PAT.fullmatch(name)
+        if mat is not None:
+            result[int(mat.group(1))] = os.path.join(topdir, name)
+    return result
+
+
+def read_flat_keyed(path):
+    """Reads a file of "<key> <value>" lines, such as cpu.stat or
+    memory.stat. Returns None if the file cannot be read.
+    """
+    data = read_text(path)
+    if data is None:
+        return None
+    result = dict()
+    for line in data.splitlines():
+        linesp = line.split()
+        if len(linesp) != 2:
+            continue
+        result[linesp[0]] = int(linesp[1])
+    return result
+
+
+def read_cpu_usec(slice_path):
+    """Returns "usage_usec" of cpu.stat, cumulative cpu time in microseconds"""
+    stat = read_flat_keyed(os.path.join(slice_path, 'cpu.stat'))
+    if stat is None:
+        return None
+    return stat.get('usage_usec')
+
+
+def read_memory_current(slice_path):
+    """Includes page cache charged to the slice, so it can exceed the RSS sum"""
+    data = read_text(os.path.join(slice_path, 'memory.current'))
+    if data is None:
+        return None
+    return int(data.strip())
+
+
+def read_memory_anon(slice_path):
+    """Returns "anon" + "shmem" of memory.stat: memory that is freed only
+    when processes exit, unlike reclaimable page cache. Heavy reads from a
+    network filesystem inflate "memory.current" but not this.
+    """
+    stat = read_flat_keyed(os.path.join(slice_path, 'memory.stat'))
+    if (stat is None) or ('anon' not in stat):
+        return None
+    return stat['anon'] + stat.get('shmem', 0)
+
+
+def read_io_bytes(slice_path):
+    """Returns (read bytes, written bytes) summed over all devices"""
+    data = read_text(os.path.join(slice_path, 'io.stat'))
+    if data is None:
+        return None, None
+
+    rbytes = wbytes = 0
+    for line in data.splitlines():
+        # <major>:<minor> rbytes=.. wbytes=.. rios=.. wios=.. ...
+        for field in line.split()[1:]:
+            key, _, val = field.partition('=')
+            if key == 'rbytes':
+                rbytes += int(val)
+            elif key == 'wbytes':
+                wbytes += int(val)
+    return rbytes, wbytes
+
+
+def read_slice_pids(slice_path):
+    """Returns pids in the slice and all of its descendant cgroups"""
+    pids = list()
+    for dirpath, dirnames, filenames in os.walk(slice_path):
+        if 'cgroup.procs' not in filenames:
+            continue
+        data = read_text(os.path.join(dirpath, 'cgroup.procs'))
+        if data is not None:
+            pids.extend(int(x) for x in data.split())
+    return sorted(pids)
+
+
+def get_user_pids(user, cgroup_root=CGROUP_ROOT):
+    """Args:
+        user: username or uid
+    """
+    uid = (user if isinstance(user, int) else get_uid_by_username(user))
+    slices = list_user_slices(cgroup_root)
+    if uid not in slices:
+        return list()
+    return read_slice_pids(slices[uid])
+
+
+def get_uid_by_username(username):
+    return pwd.getpwnam(username).pw_uid
+
+
+##############
+# collectors #
+##############
+
+def read_user_usage(cgroup_root=CGROUP_ROOT):
+    """Returns a DataFrame with one row per user slice and columns
+    USAGE_DF_COLUMNS. Counters are cumulative; see "CgroupSampler" for rates.
+    """
+    slices = list_user_slices(cgroup_root)
+    uids = sorted(slices.keys())
+    columns = dict((key, list()) for key in USAGE_DF_COLUMNS)
+    for uid in uids:
+        slice_path = slices[uid]
+        rbytes, wbytes = read_io_bytes(slice_path)
+        columns['uid'].append(uid)
+        columns['user'].append(procfs.get_username_by_uid(uid))
+        columns['cpu_usec'].append(read_cpu_usec(slice_path))
+        columns['memory_bytes'].append(read_memory_current(slice_path))
+        columns['anon_bytes'].append(read_memory_anon(slice_path))
+        columns['read_bytes'].append(rbytes)
+        columns['write_bytes'].append(wbytes)
+
+    df = pd.DataFrame(columns, columns=USAGE_DF_COLUMNS)
+    for key in USAGE_DF_COLUMNS[2:]:
+        df[key] = df[key].astype(float)
+    return df
+
+
+class CgroupSampler:
+    """Computes per-user cpu and IO rates against the counters of the
+    previous call, like psutil_funcs.RateSampler does for processes.
+
+    A user slice seen for the first time, or recreated since the previous
+    call (counters decreased), gets NaN rates.
+    """
+
+    def __init__(self, cgroup_root=CGROUP_ROOT):
+        self.cgroup_root = cgroup_root
+        self.last_time = None
+        self.last_usage = None
+
+    def sample(self, prime_interval=None):
+        """Returns the "read_user_usage" DataFrame with additional columns
+        "pcpu" (100 per fully used cpu), "read B/s" and "write B/s".
+
+        Args:
+            prime_interval: If given and there is no previous reading, a first
+                reading is taken and this many seconds are slept.
+        """
+        if (prime_interval is not None) and (self.last_usage is None):
+            self.sample()
+            time.sleep(prime_interval)
+
+        now = time.monotonic()
+        usage = read_user_usage(self.cgroup_root)
+
+        if self.last_usage is None:
+            previous = pd.DataFrame(columns=USAGE_DF_COLUMNS)
+            elapsed = np.nan
+        else:
+            previous = self.last_usage
+            elapsed = now - self.last_time
+        previous = previous.set_index('uid').reindex(usage['uid'])
+
+        for key, newkey, scale in (
+            ('cpu_usec', 'pcpu', 100 / 1e6),
+            ('read_bytes', 'read B/s', 1),
+            ('write_bytes', 'write B/s', 1),
+        ):
+            diff = usage[key].to_numpy() - previous[key].to_numpy(dtype=float)
+            diff[diff < 0] = np.nan
+            usage[newkey] = diff * scale / elapsed
+
+        self.last_time = now
+        self.last_usage = usage.loc[:, list(USAGE_DF_COLUMNS)]
+        return usage
@@ -8,8 +8,13 @@ import datetime
 
 import psutil
 import numpy as np
+import pandas as pd
 
 import utils
+import procfs
+import cgroups
+import pressure
+import psutil_funcs
 
 
 NODELIST = [
@@ -84,6 +89,51 @@ def argument_parsing():
         type=float,
         dest='kill_timeout',
     )
+    parser.add_argument(
+        '--cgroup',
+        help=f'If set, per-user cpu usage is read from systemd user slices, and only processes of the top user are enumerated.',
+        action='store_true',
+        dest='cgroup',
+    )
+    parser.add_argument(
+        '--cgroup-root',
+        help=f'cgroup v2 mount point, or a fixture directory with the same layout',
+        default=cgroups.CGROUP_ROOT,
+        dest='cgroup_root',
+    )
+    parser.add_argument(
+        '--psi',
+        help=f'If set, the watchdog wakes up as soon as cpu pressure (PSI) exceeds the trigger, instead of only every monitor interval.',
+        action='store_true',
+        dest='psi',
+    )
+    parser.add_argument(
+        '--psi-stall-ms',
+        help=f'PSI trigger fires when tasks are stalled for this many milliseconds within a window',
+        default=500,
+        type=int,
+        dest='psi_stall_ms',
+    )
+    parser.add_argument(
+        '--psi-window-ms',
+        help=f'PSI trigger window in milliseconds',
+        default=1000,
+        type=int,
+        dest='psi_window_ms',
+    )
+    parser.add_argument(
+        '--psi-min-gap',
+        help=f'With --psi, minimum time (in seconds) between the starts of two checks, so that sustained pressure does not make checks run back to back',
+        default=10,
+        type=float,
+        dest='psi_min_gap',
+    )
+    parser.add_argument(
+        '--pressure-root',
+        help=f'Directory containing PSI files. If not the default, files are read periodically instead of using triggers.',
+        default=pressure.PRESSURE_ROOT,
+        dest='pressure_root',
+    )
 
     args = parser.parse_args()
     return args
@@ -93,18 +143,22 @@ def get_load_threshold(threshold_factor=2):
     return int(os.cpu_count() * threshold_factor)
 
 
-def check_excessive_load(loadcheck_num=3, loadcheck_interval=3, threshold_factor=2):
-    loads = list()
+def check_excessive_load(loadcheck_num=3, loadcheck_interval=3, threshold_factor=2, sampler=None):
+    if sampler is None:
+        sampler = procfs.LoadSampler(window=loadcheck_num)
     for _ in range(loadcheck_num):
-        loads.append(utils.get_load_snapshot())
+        sampler.sample()
         time.sleep(loadcheck_interval)
 
-    mean_load = np.mean(loads)
+    mean_load = sampler.mean()
     return mean_load >= get_load_threshold(threshold_factor=threshold_factor)
 
 
-def kill_cpu_overuser(timeout=5, threshold_factor=2):
-    all_df, byuser_dfs = utils.get_byuser_pcpu()
+def get_maxuser_procs(rate_sampler=None):
+    if rate_sampler is None:
+        all_df, byuser_dfs = utils.get_byuser_pcpu()
+    else:
+        all_df, byuser_dfs = psutil_funcs.get_byuser_pcpu(rate_sampler)
     if 'root' in byuser_dfs:
         del byuser_dfs['root']
 
@@ -112,22 +166,84 @@ def kill_cpu_overuser(timeout=5, threshold_factor=2):
         byuser_dfs.items(),
         key=(lambda x: x[1]['pcpu'].sum())
     )[0]
-    maxuser_procs = byuser_dfs[maxuser].sort_values('pcpu', axis=0, ascending=False)
+    return byuser_dfs[maxuser]
+
+
+def get_maxuser_procs_cgroup(cgroup_sampler, rate_sampler=None):
+    """The top user is found from user slice counters, and only the 
+    processes in that slice are enumerated.
+    """
+    usage = cgroup_sampler.sample(prime_interval=0.2)
+    usage = usage.loc[(usage['user'] != 'root') & usage['pcpu'].notna(), :]
+    if usage.shape[0] == 0:
+        return pd.DataFrame(columns=['pid', 'pcpu', 'user', 'cmd'])
+
+    maxuid = int(usage.loc[usage['pcpu'].idxmax(), 'uid'])
+    pids = cgroups.get_user_pids(maxuid, cgroup_sampler.cgroup_root)
+    if rate_sampler is None:
+        rate_sampler = psutil_funcs.RateSampler()
+    return psutil_funcs.get_procs_pcpu(pids, rate_sampler)
+
 
-    killed_procs = list()
-    for idx, row in maxuser_procs.iterrows():
-        killed_procs.append(row)
-        rowdict = row.to_dict()
-        utils.kill_proc([rowdict['pid']], timeout=timeout)
-        print(f'Killed a process: {rowdict}')
+def kill_cpu_overuser(timeout=5, threshold_factor=2, rate_sampler=None, cgroup_sampler=None):
+    """Args:
+        rate_sampler: A psutil_funcs.RateSampler. If given, processes are 
+            ranked by cpu usage since its previous sample instead of the 
+            lifetime average cpu usage.
+        cgroup_sampler: A cgroups.CgroupSampler. If given, users are ranked 
+            by their user slice cpu usage.
+    """
+    if cgroup_sampler is None:
+        maxuser_procs = get_maxuser_procs(rate_sampler)
+    else:
+        maxuser_procs = get_maxuser_procs_cgroup(cgroup_sampler, rate_sampler)
 
-        if utils.get_load_snapshot() < get_load_threshold(threshold_factor=threshold_factor):
-            break
+    # plan from a single snapshot
+    thread_counts = psutil_funcs.get_thread_state_counts(maxuser_procs['pid'].tolist())
+    maxuser_procs = maxuser_procs.assign(num_RD=thread_counts['RD'])
+    load = utils.get_load_snapshot()
+    load_threshold = get_load_threshold(threshold_factor=threshold_factor)
+    killed_procs = plan_cpu_kill(maxuser_procs, load, load_threshold)
+
+    # kill all at once and verify once
+    if killed_procs.shape[0] > 0:
+        kill_results = utils.kill_procs(
+            killed_procs['pid'].tolist(), 
+            timeout=timeout, 
+            create_times=utils.get_create_times(killed_procs),
+        )
+        killed_procs = killed_procs.merge(kill_results, on='pid', how='left')
+        for rowdict in killed_procs.to_dict(orient='records'):
+            print(f'Killed a process: {rowdict}')
+    load_after = utils.get_load_snapshot()
+    print(
+        f'Load before killing: {load}, expected after killing: '
+        f'{load - killed_procs["num_RD"].sum()}, actual: {load_after}, '
+        f'threshold: {load_threshold}'
+    )
 
-    killed_procs = pd.DataFrame.from_records(killed_procs)
     return killed_procs
 
 
+def plan_cpu_kill(procs_df, load, load_threshold):
+    """Picks the fewest processes whose R/D threads, when removed, bring 
+    "load" below "load_threshold". Processes with more R/D threads are picked 
+    first, with ties broken by pcpu. If even all of them are not enough, every 
+    process with R/D threads is picked.
+
+    Args:
+        procs_df: Has columns "pid", "pcpu" and "num_RD".
+    """
+    excess = load - load_threshold + 1
+    if excess <= 0:
+        return procs_df.iloc[:0, :]
+
+    candidates = procs_df.loc[procs_df['num_RD'] > 0, :].sort_values(
+        ['num_RD', 'pcpu'], axis=0, ascending=False,
+    )
+    cumsum = candidates['num_RD'].cumsum().to_numpy()
+    num_picked = min(np.searchsorted(cumsum, excess) + 1, candidates.shape[0])
+    return candidates.iloc[:num_picked, :]
 
 
 def monitor(
@@ -138,24 +254,62 @@ def monitor(
     threshold_stopkill=1, 
     monitor_interval=60,
     kill_timeout=5,
+    cgroup=False,
+    cgroup_root=cgroups.CGROUP_ROOT,
+    psi=False,
+    psi_stall_ms=500,
+    psi_window_ms=1000,
+    psi_min_gap=10,
+    pressure_root=pressure.PRESSURE_ROOT,
 ):
     hostname = socket.gethostname()
-    while True:
-        utils.print_timestamp(f'{hostname}: Checking CPU usage')
-        if check_excessive_load(
-            loadcheck_num=loadcheck_num, 
-            loadcheck_interval=loadcheck_interval, 
-            threshold_factor=threshold_beginkill,
-        ):
-            killed_procs = kill_cpu_overuser(
-                timeout=kill_timeout, 
-                threshold_factor=threshold_stopkill,
-            )
-            utils.write_log(killed_procs, logdir)
-            utils.print_timestamp(f'{hostname}: Finished killing. Sleeping for {monitor_interval} seconds')
-        else:
-            utils.print_timestamp(f'{hostname}: CPU usage below threshold. Sleeping for {monitor_interval} seconds')
-        time.sleep(monitor_interval)
+    watcher = (
+        pressure.PressureWatcher(
+            'cpu', 
+            stall_ms=psi_stall_ms, 
+            window_ms=psi_window_ms, 
+            pressure_root=pressure_root,
+        )
+        if psi else
+        None
+    )
+    sampler = procfs.LoadSampler(window=loadcheck_num)
+    rate_sampler = psutil_funcs.RateSampler()
+    cgroup_sampler = (cgroups.CgroupSampler(cgroup_root) if cgroup else None)
+    wait_msg = pressure.describe_wait(watcher, monitor_interval, psi_min_gap)
+    try:
+        while True:
+            last_check = time.monotonic()
+            utils.print_timestamp(f'{hostname}: Checking CPU usage')
+            if check_excessive_load(
+                loadcheck_num=loadcheck_num, 
+                loadcheck_interval=loadcheck_interval, 
+                threshold_factor=threshold_beginkill,
+                sampler=sampler,
+            ):
+                killed_procs = kill_cpu_overuser(
+                    timeout=kill_timeout, 
+                    threshold_factor=threshold_stopkill,
+                    rate_sampler=rate_sampler,
+                    cgroup_sampler=cgroup_sampler,
+                )
+                utils.write_log(killed_procs, logdir)
+                utils.print_timestamp(f'{hostname}: Finished killing. {wait_msg}')
+            else:
+                utils.print_timestamp(f'{hostname}: CPU usage below threshold. {wait_msg}')
+
+            # cpu times are recorded every cycle, so that pcpu at kill time 
+            # covers the last monitor interval
+            if cgroup_sampler is None:
+                rate_sampler.sample(list(psutil.process_iter()), IO=False)
+            else:
+                cgroup_sampler.sample()
+            if pressure.wait_for_next_check(watcher, monitor_interval, last_check, psi_min_gap):
+                # begin/stop thresholds are still checked after waking up
+                utils.print_timestamp(f'{hostname}: CPU pressure exceeded the PSI trigger')
+    finally:
+        if watcher is not None:
+            watcher.close()
 
 
 def main():
@@ -0,0 +1,307 @@
+"""Exports per-user and per-node resource usage in the Prometheus text
+exposition format.
+
+A background thread takes a ProcessSnapshot every "interval" seconds and
+renders all metrics once. Scrapes of the HTTP endpoint and writes of the
+node_exporter textfile only copy the rendered bytes, so they never read
+/proc.
+
+Usage:
+    python exporter.py --port 9469
+    python exporter.py --textfile /var/lib/node_exporter/textfile_collector/svadmin.prom
+"""
+
+import os
+import time
+import argparse
+import threading
+import http.server
+
+import psutil
+import pandas as pd
+
+import utils
+import psutil_funcs
+import procsnapshot
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRICS_PATH = '/metrics'
+
+EXPORT_AGGSPEC = {
+    'group_keys': ['user'],
+    'sum': [
+        'pcpu_total',
+        'pcpu_iowait',
+        'num_RD',
+        'rss_bytes',
+        'pss_bytes',
+        'read B/s',
+        'write B/s',
+    ],
+    'max': list(),
+    'topn': 0,
+    'topn_by': list(),
+    'topn_columns': list(),
+}
+
+# (metric name, column of the grouped DataFrame, help text)
+USER_METRICS = [
+    ('svadmin_user_cpu_percent', 'pcpu_total', 'CPU usage of the processes of the user, in percent of one cpu'),
+    ('svadmin_user_cpu_iowait_percent', 'pcpu_iowait', 'IO wait of the processes of the user, in percent of one cpu'),
+    ('svadmin_user_running_threads', 'num_RD', 'Threads of the user in R or D state'),
+    ('svadmin_user_processes', 'num_procs', 'Processes of the user'),
+    ('svadmin_user_rss_bytes', 'rss_bytes', 'Resident memory of the processes of the user'),
+    ('svadmin_user_pss_bytes', 'pss_bytes', 'Proportional set size of the processes of the user; requires root'),
+    ('svadmin_user_read_bytes_per_second', 'read B/s', 'Disk read rate of the processes of the user'),
+    ('svadmin_user_write_bytes_per_second', 'write B/s', 'Disk write rate of the processes of the user'),
+]
+
+# (metric name, key of the node dict, help text)
+NODE_METRICS = [
+    ('svadmin_node_cpus', 'cpus', 'Number of logical cpus'),
+    ('svadmin_node_running_threads', 'load', 'Threads in R or D state, from /proc/stat'),
+    ('svadmin_node_memory_total_bytes', 'memory_total', 'Total memory'),
+    ('svadmin_node_memory_available_bytes', 'memory_available', 'Available memory'),
+    ('svadmin_node_processes', 'num_procs', 'Processes seen by the sampler'),
+    ('svadmin_exporter_sample_duration_seconds', 'sample_sec', 'Time spent taking and rendering the latest sample'),
+    ('svadmin_exporter_last_sample_timestamp_seconds', 'timestamp', 'Unix time of the latest sample'),
+]
+
+
+def argument_parsing():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--port',
+        help=f'If given, metrics are served over HTTP at {METRICS_PATH} on this port.',
+        default=None,
+        type=int,
+        dest='port',
+    )
+    parser.add_argument(
+        '--address',
+        help=f'Address the HTTP server binds to',
+        default='',
+        dest='address',
+    )
+    parser.add_argument(
+        '--textfile',
+        help=f'If given, metrics are written to this file (for the textfile collector of node_exporter) after each sample.',
+        default=None,
+        dest='textfile',
+    )
+    parser.add_argument(
+        '--interval',
+        help=f'Time interval (in seconds) between each sample',
+        default=15,
+        type=float,
+        dest='interval',
+    )
+    parser.add_argument(
+        '--pcpu-interval',
+        help=f'Time interval (in seconds) to collect cpu usage data for the first sample. Later samples use the previous one.',
+        default=1,
+        type=float,
+        dest='pcpu_interval',
+    )
+
+    args = parser.parse_args()
+    if (args.port is None) and (args.textfile is None):
+        raise Exception(f'At least one of "--port" or "--textfile" must be given.')
+    return args
+
+
+#############
+# rendering #
+#############
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metric(lines, name, helptext, samples):
+    """Args:
+        samples: iterable of (label string, value). NaN values are omitted.
+    """
+    lines.append(f'# HELP {name} {helptext}')
+    lines.append(f'# TYPE {name} gauge')
+    for labels, value in samples:
+        if pd.isna(value):
+            continue
+        lines.append(f'{name}{labels} {float(value)!r}')
+
+
+def render_user_metrics(grouped):
+    """Returns a list of lines.
+
+    Args:
+        grouped: DataFrame indexed by user, with the columns of USER_METRICS
+    """
+    lines = list()
+    user_labels = [f'{{user="{escape_label_value(x)}"}}' for x in grouped.index]
+    for name, column, helptext in USER_METRICS:
+        render_metric(lines, name, helptext, zip(user_labels, grouped[column]))
+    return lines
+
+
+def render_node_metrics(node):
+    """Returns a list of lines.
+
+    Args:
+        node: dict with the keys of NODE_METRICS
+    """
+    lines = list()
+    for name, key, helptext in NODE_METRICS:
+        render_metric(lines, name, helptext, [('', node[key])])
+    return lines
+
+
+def join_lines(lines):
+    return '\n'.join(lines + ['']).encode()
+
+
+def render(grouped, node):
+    """Returns the exposition text as bytes"""
+    return join_lines(render_user_metrics(grouped) + render_node_metrics(node))
+
+
+def write_textfile(path, payload):
+    """Written through a temporary file, so node_exporter never reads a
+    partially written file.
+    """
+    tmppath = f'{path}.tmp'
+    with open(tmppath, 'wb') as f:
+        f.write(payload)
+    os.replace(tmppath, path)
+
+
+############
+# sampling #
+############
+
+def collect(sampler, pcpu_interval=1):
+    """Returns (grouped, node) arguments of "render" """
+    snapshot = procsnapshot.ProcessSnapshot.from_psutil(sampler=sampler, interval=pcpu_interval)
+    grouped = procsnapshot.aggregate_snapshot_df(snapshot.df, EXPORT_AGGSPEC)['grouped']
+    grouped['num_procs'] = snapshot.df.groupby(level='user').size()
+
+    vmem = psutil.virtual_memory()
+    node = {
+        'cpus': psutil.cpu_count(),
+        'load': utils.get_load_snapshot(),
+        'memory_total': vmem.total,
+        'memory_available': vmem.available,
+        'num_procs': snapshot.num_procs,
+    }
+    return grouped, node
+
+
+class Exporter:
+    """Samples in a background thread and keeps the rendered metrics in
+    "payload". Replacing "payload" is atomic, so readers need no lock.
+
+    Args:
+        textfile: If given, "payload" is also written to this path after
+            each sample.
+    """
+
+    def __init__(self, interval=15, pcpu_interval=1, textfile=None):
+        self.interval = interval
+        self.pcpu_interval = pcpu_interval
+        self.textfile = textfile
+        self.sampler = psutil_funcs.RateSampler()
+        self.payload = b''
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        t0 = time.perf_counter()
+        grouped, node = collect(self.sampler, pcpu_interval=self.pcpu_interval)
+        user_lines = render_user_metrics(grouped)
+        node['timestamp'] = time.time()
+        # the node block, which holds the duration itself, is a few lines
+        # and is rendered after the measurement
+        node['sample_sec'] = time.perf_counter() - t0
+        self.payload = join_lines(user_lines + render_node_metrics(node))
+        if self.textfile is not None:
+            write_textfile(self.textfile, self.payload)
+
+    def run(self):
+        """A failed sample is reported and the previous payload is kept;
+        its age is visible in svadmin_exporter_last_sample_timestamp_seconds.
+        """
+        deadline = time.monotonic()
+        while True:
+            deadline = max(deadline + self.interval, time.monotonic())
+            if self.stop_event.wait(deadline - time.monotonic()):
+                break
+            try:
+                self.sample()
+            except Exception as exc:
+                utils.print_timestamp(f'Sampling failed: {exc}')
+
+    def start(self):
+        """The first sample is taken before returning, so that the payload
+        is never empty once served.
+        """
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+########
+# http #
+########
+
+def make_handler_class(exporter):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        # keep-alive; every response has a Content-Length. Without
+        # TCP_NODELAY, the body would wait for the ack of the headers.
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if self.path != METRICS_PATH:
+                self.send_error(404)
+                return
+            payload = exporter.payload
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            # scrapes are not logged
+            pass
+
+    return MetricsHandler
+
+
+def main():
+    args = argument_parsing()
+    exporter = Exporter(
+        interval=args.interval, pcpu_interval=args.pcpu_interval, textfile=args.textfile,
+    )
+    exporter.start()
+
+    if args.port is None:
+        exporter.thread.join()
+    else:
+        server = http.server.ThreadingHTTPServer(
+            (args.address, args.port), make_handler_class(exporter),
+        )
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            exporter.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 import subprocess
 import re
 import json
-import multiprocessing
 import socket
 
 import pandas as pd
@@ -15,6 +14,9 @@ PAT_LINE2 = re.compile(PATSTR_BASE.format('Actual DISK READ', 'Actual DISK WRITE
 
 EXPONENTS = {'B': 0, 'K': 1, 'M': 2, 'G': 3, 'T': 4}
 
+# seconds to wait for each node; a hung node is shown as NA
+NODE_TIMEOUT = 30
+
 
 def postprocess(string):
     # string: 55.36 K/s
@@ -50,10 +52,12 @@ def main():
     utils.rootcheck()
 
     # run iotop over ssh
-    with multiprocessing.Pool() as pool:
-        argsiter = ((x, run_iotop) for x in utils.ALL_NODES)
-        #node_results = pool.starmap(utils.run_over_ssh, argsiter)
-        node_results = dict(zip(utils.ALL_NODES, pool.starmap(utils.run_over_ssh, argsiter)))
+    node_results = dict(
+        zip(
+            utils.ALL_NODES, 
+            utils.run_over_nodes(utils.ALL_NODES, run_iotop, timeout=NODE_TIMEOUT),
+        )
+    )
 
     # make result dataframe
     df_records = list()
@@ -3,6 +3,16 @@ import pprint
 import time
 import signal
 import socket
+import argparse
+
+import psutil
+import numpy as np
+import pandas as pd
+
+import utils
+import psutil_funcs
+import cgroups
+import pressure
 
 
 NODELIST = [
@@ -49,6 +59,13 @@ def argument_parsing():
         type=float,
         dest='threshold_stopkill',
     )
+    parser.add_argument(
+        '--pss-topk-users',
+        help=f'PSS is measured only for processes of this many users with the largest RSS',
+        default=3,
+        type=int,
+        dest='pss_topk_users',
+    )
     parser.add_argument(
         '--monitor-interval',
         help=f'Time interval (in seconds) between each CPU monitor cycle',
@@ -63,6 +80,51 @@ def argument_parsing():
         type=float,
         dest='kill_timeout',
     )
+    parser.add_argument(
+        '--cgroup',
+        help=f'If set, per-user memory usage is read from systemd user slices, and only processes of the top user are enumerated.',
+        action='store_true',
+        dest='cgroup',
+    )
+    parser.add_argument(
+        '--cgroup-root',
+        help=f'cgroup v2 mount point, or a fixture directory with the same layout',
+        default=cgroups.CGROUP_ROOT,
+        dest='cgroup_root',
+    )
+    parser.add_argument(
+        '--psi',
+        help=f'If set, the watchdog wakes up as soon as memory pressure (PSI) exceeds the trigger, instead of only every monitor interval.',
+        action='store_true',
+        dest='psi',
+    )
+    parser.add_argument(
+        '--psi-stall-ms',
+        help=f'PSI trigger fires when tasks are stalled for this many milliseconds within a window',
+        default=100,
+        type=int,
+        dest='psi_stall_ms',
+    )
+    parser.add_argument(
+        '--psi-window-ms',
+        help=f'PSI trigger window in milliseconds',
+        default=1000,
+        type=int,
+        dest='psi_window_ms',
+    )
+    parser.add_argument(
+        '--psi-min-gap',
+        help=f'With --psi, minimum time (in seconds) between the starts of two checks, so that sustained pressure does not make checks run back to back',
+        default=10,
+        type=float,
+        dest='psi_min_gap',
+    )
+    parser.add_argument(
+        '--pressure-root',
+        help=f'Directory containing PSI files. If not the default, files are read periodically instead of using triggers.',
+        default=pressure.PRESSURE_ROOT,
+        dest='pressure_root',
+    )
 
     args = parser.parse_args()
     return args
@@ -73,15 +135,26 @@ def check_excessive_memuse(threshold_factor):
     return memuse_fraction >= threshold_factor
 
 
-def kill_mem_overuser(timeout, threshold_factor, memtype):
+def get_memtype_column(memtype):
     if memtype == 'pss':
-        df_col = 'pss_bytes'
+        return 'pss_bytes'
     elif memtype == 'rss':
-        df_col = 'rss_bytes'
+        return 'rss_bytes'
     else:
         raise Exception(f'"memtype" must be either pss or rss')
 
-    all_df, byuser_dfs = utils.get_byuser_mem()
+
+def get_maxuser_procs(memtype, pss_topk_users=3):
+    df_col = get_memtype_column(memtype)
+
+    # Users are first ranked by the cheap RSS; PSS is read only for the
+    # processes of the top users.
+    all_df, byuser_dfs = psutil_funcs.get_byuser_mem(
+        tiered=True, 
+        topk_procs=0, 
+        topk_users=(pss_topk_users if memtype == 'pss' else 0),
+        exclude_users=('root',),
+    )
     if 'root' in byuser_dfs:
         del byuser_dfs['root']
 
@@ -89,20 +162,99 @@ def kill_mem_overuser(timeout, threshold_factor, memtype):
         byuser_dfs.items(),
         key=(lambda x: x[1][df_col].sum())
     )[0]
-    maxuser_procs = byuser_dfs[maxuser].sort_values(df_col, axis=0, ascending=False)
+    return byuser_dfs[maxuser]
+
+
+def get_maxuser_procs_cgroup(cgroup_root):
+    """The top user is found from anonymous and shared memory of user
+    slices (page cache is not counted), and only the processes in that
+    slice are enumerated.
+    """
+    usage = cgroups.read_user_usage(cgroup_root)
+    usage = usage.loc[(usage['user'] != 'root') & usage['anon_bytes'].notna(), :]
+    if usage.shape[0] == 0:
+        return pd.DataFrame(columns=['pid', 'rss_bytes', 'pss_bytes', 'uss_bytes', 'user', 'cmd'])
+
+    maxuid = int(usage.loc[usage['anon_bytes'].idxmax(), 'uid'])
+    pids = cgroups.get_user_pids(maxuid, cgroup_root)
+    return psutil_funcs.get_procs_mem(pids)
+
+
+def kill_mem_overuser(timeout, threshold_factor, memtype, pss_topk_users=3, cgroup_root=None):
+    """Args:
+        cgroup_root: If given, users are ranked by their user slice memory 
+            usage under this cgroup v2 mount point.
+    """
+    if cgroup_root is None:
+        maxuser_procs = get_maxuser_procs(memtype, pss_topk_users=pss_topk_users)
+    else:
+        maxuser_procs = get_maxuser_procs_cgroup(cgroup_root)
+
+    # plan from a single collection
+    vmem_before = psutil.virtual_memory()
+    bytes_to_free = get_bytes_to_free(vmem_before, threshold_factor)
+    killed_procs = plan_mem_kill(maxuser_procs, bytes_to_free, memtype)
+
+    # kill all at once and measure once
+    if killed_procs.shape[0] > 0:
+        kill_results = utils.kill_procs(
+            killed_procs['pid'].tolist(), 
+            timeout=timeout, 
+            create_times=utils.get_create_times(killed_procs),
+        )
+        killed_procs = killed_procs.merge(kill_results, on='pid', how='left')
+        for rowdict in killed_procs.to_dict(orient='records'):
+            print(f'Killed a process: {rowdict}')
+    vmem_after = psutil.virtual_memory()
 
-    killed_procs = list()
-    for idx, row in maxuser_procs.iterrows():
-        killed_procs.append(row)
-        rowdict = row.to_dict()
-        utils.kill_proc([rowdict['pid']], timeout=timeout)
-        print(f'Killed a process: {rowdict}')
+    summary = {
+        'bytes_to_free': int(bytes_to_free),
+        'predicted_freed_bytes': int(killed_procs['predicted_freed_bytes'].sum()),
+        'actual_freed_bytes': int(vmem_after.available - vmem_before.available),
+        'memuse_percent_before': vmem_before.percent,
+        'memuse_percent_after': vmem_after.percent,
+    }
+    print(f'Memory kill summary: {summary}')
 
-        if not check_excessive_memuse(threshold_factor=threshold_factor):
-            break
+    return killed_procs, summary
 
-    killed_procs = pd.DataFrame.from_records(killed_procs)
-    return killed_procs
+
+def get_bytes_to_free(vmem, threshold_factor):
+    """Bytes to be freed so that memory use falls below "threshold_factor" 
+    of total memory, as measured by "check_excessive_memuse".
+    """
+    used = vmem.total - vmem.available
+    return max(used - int(vmem.total * threshold_factor) + 1, 0)
+
+
+def plan_mem_kill(procs_df, bytes_to_free, memtype='pss'):
+    """Picks the fewest processes expected to free "bytes_to_free".
+
+    The memory freed by killing a process is estimated by its USS, since 
+    pages shared with surviving processes are not freed and PSS counts a 
+    share of them. Where USS is not available, PSS (for memtype "pss") or 
+    RSS is used. Processes are picked in descending order of the estimate. 
+    If even all of them are not enough, all are picked.
+
+    Returns:
+        The picked rows of "procs_df", with an added column 
+        "predicted_freed_bytes".
+    """
+    estimate = procs_df['uss_bytes'].astype(float)
+    if memtype == 'pss':
+        estimate = estimate.fillna(procs_df['pss_bytes'].astype(float))
+    estimate = estimate.fillna(procs_df['rss_bytes'].astype(float))
+
+    candidates = procs_df.assign(predicted_freed_bytes=estimate.to_numpy())
+    if bytes_to_free <= 0:
+        return candidates.iloc[:0, :]
+
+    candidates = candidates.sort_values(
+        'predicted_freed_bytes', axis=0, ascending=False,
+    )
+    cumsum = candidates['predicted_freed_bytes'].cumsum().to_numpy()
+    num_picked = min(np.searchsorted(cumsum, bytes_to_free) + 1, candidates.shape[0])
+    return candidates.iloc[:num_picked, :]
 
 
 def monitor(
@@ -112,21 +264,49 @@ def monitor(
     memtype='pss', 
     monitor_interval=60, 
     kill_timeout=5,
+    pss_topk_users=3,
+    cgroup=False,
+    cgroup_root=cgroups.CGROUP_ROOT,
+    psi=False,
+    psi_stall_ms=100,
+    psi_window_ms=1000,
+    psi_min_gap=10,
+    pressure_root=pressure.PRESSURE_ROOT,
 ):
     hostname = socket.gethostname()
-    while True:
-        utils.print_timestamp(f'{hostname}: Checking memory usage')
-        if check_excessive_memuse(threshold_factor=threshold_beginkill):
-            killed_procs = kill_mem_overuser(
-                timeout=kill_timeout, 
-                threshold_factor=threshold_stopkill, 
-                memtype=memtype,
-            )
-            utils.write_log(killed_procs, logdir)
-            utils.print_timestamp(f'{hostname}: Finished killing. Sleeping for {monitor_interval} seconds')
-        else:
-            utils.print_timestamp(f'{hostname}: Memory usage below threshold. Sleeping for {monitor_interval} seconds')
-        time.sleep(monitor_interval)
+    watcher = (
+        pressure.PressureWatcher(
+            'memory', 
+            stall_ms=psi_stall_ms, 
+            window_ms=psi_window_ms, 
+            pressure_root=pressure_root,
+        )
+        if psi else
+        None
+    )
+    wait_msg = pressure.describe_wait(watcher, monitor_interval, psi_min_gap)
+    try:
+        while True:
+            last_check = time.monotonic()
+            utils.print_timestamp(f'{hostname}: Checking memory usage')
+            if check_excessive_memuse(threshold_factor=threshold_beginkill):
+                killed_procs, summary = kill_mem_overuser(
+                    timeout=kill_timeout, 
+                    threshold_factor=threshold_stopkill, 
+                    memtype=memtype,
+                    pss_topk_users=pss_topk_users,
+                    cgroup_root=(cgroup_root if cgroup else None),
+                )
+                utils.write_log(killed_procs, logdir, summary=summary)
+                utils.print_timestamp(f'{hostname}: Finished killing. {wait_msg}')
+            else:
+                utils.print_timestamp(f'{hostname}: Memory usage below threshold. {wait_msg}')
+            if pressure.wait_for_next_check(watcher, monitor_interval, last_check, psi_min_gap):
+                # begin/stop thresholds are still checked after waking up
+                utils.print_timestamp(f'{hostname}: Memory pressure exceeded the PSI trigger')
+    finally:
+        if watcher is not None:
+            watcher.close()
 
 
 def main():
@@ -0,0 +1,467 @@
+import os
+import abc
+import time
+import socket
+import argparse
+import functools
+
+import psutil
+import pandas as pd
+
+import utils
+import procfs
+import psutil_funcs
+import cpu_watchdog
+import memory_watchdog
+
+
+NODE_DF_ATTRS = ('username', 'cmdline', 'memory_info', 'create_time')
+PROTECTED_USERS = ('root',)
+
+
+def argument_parsing():
+    def nodes_postprocess(x):
+        if x is None:
+            return [socket.gethostname()]
+        else:
+            return x.split(',')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--logdir',
+        help=f'Directory where log files are stored.',
+        required=True,
+        dest='logdir',
+    )
+    parser.add_argument(
+        '--nodes',
+        help=f'Comma-separated string indicating target nodes. (e.g. bnode2,bnode4) Default: current node.',
+        default=None,
+        type=nodes_postprocess,
+        dest='nodes',
+    )
+    parser.add_argument(
+        '--policies',
+        help=f'Comma-separated policy names, in order of priority. Available: {",".join(POLICY_CLASSES.keys())}',
+        default='memory,cpu',
+        type=(lambda x: x.split(',')),
+        dest='policies',
+    )
+    parser.add_argument(
+        '--tick-interval',
+        help=f'Time interval (in seconds) between each tick',
+        default=5,
+        type=float,
+        dest='tick_interval',
+    )
+    parser.add_argument(
+        '--kill-timeout',
+        help=f'Time (in seconds) to wait after sending SIGTERM to a process',
+        default=5,
+        type=float,
+        dest='kill_timeout',
+    )
+
+    # cpu policy
+    parser.add_argument(
+        '--checknum',
+        help=f'The number of ticks over which load is averaged',
+        default=3,
+        type=int,
+        dest='loadcheck_num',
+    )
+    parser.add_argument(
+        '--cpu-beginkill-threshold',
+        help=f'Factor to be multiplied to the total cpu count, which will serve as a threshold above which killing will begin',
+        default=2,
+        type=float,
+        dest='cpu_threshold_beginkill',
+    )
+    parser.add_argument(
+        '--cpu-stopkill-threshold',
+        help=f'Factor to be multiplied to the total cpu count, which will serve as a threshold below which killing will stop',
+        default=1,
+        type=float,
+        dest='cpu_threshold_stopkill',
+    )
+
+    # memory policy
+    parser.add_argument(
+        '--mem-beginkill-threshold',
+        help=f'Factor to be multiplied to the total memory, which will serve as a threshold above which killing will begin',
+        default=0.9,
+        type=float,
+        dest='mem_threshold_beginkill',
+    )
+    parser.add_argument(
+        '--mem-stopkill-threshold',
+        help=f'Factor to be multiplied to the total memory, which will serve as a threshold below which killing will stop',
+        default=0.8,
+        type=float,
+        dest='mem_threshold_stopkill',
+    )
+    parser.add_argument(
+        '--memtype',
+        help=f'Memory measure by which users and processes are ranked (pss or rss)',
+        default='pss',
+        choices=('pss', 'rss'),
+        dest='memtype',
+    )
+    parser.add_argument(
+        '--pss-topk-users',
+        help=f'PSS is measured only for processes of this many users with the largest RSS',
+        default=3,
+        type=int,
+        dest='pss_topk_users',
+    )
+
+    args = parser.parse_args()
+    # "type" is not applied to a default of None
+    if args.nodes is None:
+        args.nodes = nodes_postprocess(None)
+    return args
+
+
+#################
+# tick snapshot #
+#################
+
+class TickSnapshot:
+    """Data shared by all policies within a tick. Each item is collected
+    only when a policy first asks for it, so a tick in which no policy
+    fires reads only /proc/stat and /proc/meminfo (and the cpu times 
+    recorded by "monitor").
+    """
+
+    def __init__(self, rate_sampler, pcpu_interval=0.2):
+        self.rate_sampler = rate_sampler
+        self.pcpu_interval = pcpu_interval
+
+    @functools.cached_property
+    def load(self):
+        return utils.get_load_snapshot()
+
+    @functools.cached_property
+    def vmem(self):
+        return psutil.virtual_memory()
+
+    @functools.cached_property
+    def procs_df(self):
+        """One walk over all processes, with columns of
+        "psutil_funcs.make_rss_df" and "pcpu".
+        """
+        proclist = [
+            x for x in psutil.process_iter(attrs=NODE_DF_ATTRS)
+            if x.info['memory_info'] is not None
+        ]
+        df = psutil_funcs.make_rss_df(proclist)
+        pcpus, _ = self.rate_sampler.sample(
+            proclist, IO=False, prime_interval=self.pcpu_interval,
+        )
+        df['pcpu'] = pcpus['user'] + pcpus['system'] + pcpus['iowait']
+        return df
+
+    @functools.cached_property
+    def user_procs_df(self):
+        """"procs_df" without processes of PROTECTED_USERS"""
+        return self.procs_df.loc[~self.procs_df['user'].isin(PROTECTED_USERS), :]
+
+    def get_thread_state_counts(self, pids):
+        return psutil_funcs.get_thread_state_counts(pids)
+
+    def add_smaps_rollup(self, procs_df, selected):
+        return psutil_funcs.add_smaps_rollup(procs_df, selected)
+
+
+############
+# policies #
+############
+
+class Policy(abc.ABC):
+    """A policy decides whether the node is overloaded (check), ranks users
+    by their share of the overload (rank_users), picks processes of a user
+    to kill (plan), and summarizes the effect after killing (verify).
+    Policies read the node only through TickSnapshot objects.
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def check(self, snapshot):
+        """Returns True if the node is overloaded"""
+
+    @abc.abstractmethod
+    def rank_users(self, snapshot):
+        """Returns a Series indexed by user, in descending order"""
+
+    @abc.abstractmethod
+    def plan(self, snapshot, user):
+        """Returns (planned processes DataFrame, summary dict)"""
+
+    def verify(self, killed_procs, summary, snapshot_after):
+        return summary
+
+
+class CPUPolicy(Policy):
+    name = 'cpu'
+
+    def __init__(self, threshold_beginkill=2, threshold_stopkill=1, loadcheck_num=3):
+        self.threshold_beginkill = threshold_beginkill
+        self.threshold_stopkill = threshold_stopkill
+        self.load_sampler = procfs.LoadSampler(window=loadcheck_num)
+
+    def check(self, snapshot):
+        # one load sample per tick; the mean covers the last "loadcheck_num" ticks
+        self.load_sampler.record(snapshot.load)
+        return (
+            self.load_sampler.is_full()
+            and (
+                self.load_sampler.mean()
+                >= cpu_watchdog.get_load_threshold(self.threshold_beginkill)
+            )
+        )
+
+    def rank_users(self, snapshot):
+        return snapshot.user_procs_df.groupby('user')['pcpu'].sum().sort_values(ascending=False)
+
+    def plan(self, snapshot, user):
+        procs_df = snapshot.user_procs_df.loc[snapshot.user_procs_df['user'] == user, :]
+        thread_counts = snapshot.get_thread_state_counts(procs_df['pid'].tolist())
+        procs_df = procs_df.assign(num_RD=thread_counts['RD'])
+        load_threshold = cpu_watchdog.get_load_threshold(self.threshold_stopkill)
+        planned = cpu_watchdog.plan_cpu_kill(procs_df, snapshot.load, load_threshold)
+        summary = {
+            'load_before': int(snapshot.load),
+            'load_threshold': load_threshold,
+            'expected_load_after': int(snapshot.load - planned['num_RD'].sum()),
+        }
+        return planned, summary
+
+    def verify(self, killed_procs, summary, snapshot_after):
+        summary['load_after'] = int(snapshot_after.load)
+        return summary
+
+
+class MemoryPolicy(Policy):
+    name = 'memory'
+
+    def __init__(self, threshold_beginkill=0.9, threshold_stopkill=0.8, memtype='pss', pss_topk_users=3):
+        self.threshold_beginkill = threshold_beginkill
+        self.threshold_stopkill = threshold_stopkill
+        self.memtype = memtype
+        self.df_col = memory_watchdog.get_memtype_column(memtype)
+        self.pss_topk_users = pss_topk_users
+        self.mem_df = None
+
+    def check(self, snapshot):
+        self.mem_df = None
+        return snapshot.vmem.percent / 100 >= self.threshold_beginkill
+
+    def get_mem_df(self, snapshot):
+        """Users are first ranked by RSS; PSS and USS are read only for
+        processes of the top users.
+        """
+        if self.mem_df is None:
+            procs_df = snapshot.user_procs_df.copy()
+            top_users = (
+                procs_df.groupby('user')['rss_bytes'].sum().nlargest(self.pss_topk_users).index
+                if self.memtype == 'pss' else
+                list()
+            )
+            snapshot.add_smaps_rollup(procs_df, procs_df['user'].isin(top_users).to_numpy())
+            self.mem_df = procs_df
+        return self.mem_df
+
+    def rank_users(self, snapshot):
+        return self.get_mem_df(snapshot).groupby('user')[self.df_col].sum().sort_values(ascending=False)
+
+    def plan(self, snapshot, user):
+        mem_df = self.get_mem_df(snapshot)
+        procs_df = mem_df.loc[mem_df['user'] == user, :]
+        bytes_to_free = memory_watchdog.get_bytes_to_free(snapshot.vmem, self.threshold_stopkill)
+        planned = memory_watchdog.plan_mem_kill(procs_df, bytes_to_free, self.memtype)
+        summary = {
+            'memuse_percent_before': snapshot.vmem.percent,
+            'bytes_to_free': int(bytes_to_free),
+            'predicted_freed_bytes': int(planned['predicted_freed_bytes'].sum()),
+            'available_before': int(snapshot.vmem.available),
+        }
+        return planned, summary
+
+    def verify(self, killed_procs, summary, snapshot_after):
+        vmem_after = snapshot_after.vmem
+        summary['memuse_percent_after'] = vmem_after.percent
+        summary['actual_freed_bytes'] = int(vmem_after.available - summary['available_before'])
+        return summary
+
+
+POLICY_CLASSES = {
+    'cpu': CPUPolicy,
+    'memory': MemoryPolicy,
+}
+
+
+def make_policies(
+    policy_names,
+    loadcheck_num=3,
+    cpu_threshold_beginkill=2,
+    cpu_threshold_stopkill=1,
+    mem_threshold_beginkill=0.9,
+    mem_threshold_stopkill=0.8,
+    memtype='pss',
+    pss_topk_users=3,
+):
+    policies = list()
+    for name in policy_names:
+        if name == 'cpu':
+            policies.append(
+                CPUPolicy(
+                    threshold_beginkill=cpu_threshold_beginkill,
+                    threshold_stopkill=cpu_threshold_stopkill,
+                    loadcheck_num=loadcheck_num,
+                )
+            )
+        elif name == 'memory':
+            policies.append(
+                MemoryPolicy(
+                    threshold_beginkill=mem_threshold_beginkill,
+                    threshold_stopkill=mem_threshold_stopkill,
+                    memtype=memtype,
+                    pss_topk_users=pss_topk_users,
+                )
+            )
+        else:
+            raise Exception(f'Unknown policy name: {repr(name)}')
+    return policies
+
+
+########
+# tick #
+########
+
+def arbitrate(policies, snapshot):
+    """Each fired policy, in order of priority, claims its top user. A policy
+    whose top user is already claimed is deferred to the next tick, since the
+    kills of the other policy may resolve it.
+
+    Returns:
+        A list of (policy, user, planned processes, summary)
+    """
+    plans = list()
+    claimed_users = set()
+    for policy in policies:
+        ranking = policy.rank_users(snapshot)
+        if ranking.shape[0] == 0:
+            continue
+        user = ranking.index[0]
+        if user in claimed_users:
+            print(f'Policy {policy.name}: user {user} is already targeted by another policy; deferred')
+            continue
+        claimed_users.add(user)
+        planned, summary = policy.plan(snapshot, user)
+        plans.append((policy, user, planned, summary))
+    return plans
+
+
+def run_tick(policies, make_snapshot, logdir=None, kill_timeout=5, kill_func=utils.kill_procs):
+    """Args:
+        make_snapshot: Called with no argument to get a TickSnapshot, once
+            before and once after killing.
+        logdir: If None, kills are not logged to files.
+        kill_func: Called like "utils.kill_procs"
+
+    Returns:
+        A dict of per-tick overhead in seconds and the names of fired policies
+    """
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+
+    snapshot = make_snapshot()
+    fired = [x for x in policies if x.check(snapshot)]
+    plans = arbitrate(fired, snapshot)
+
+    overhead = {
+        'collect_wall_sec': time.perf_counter() - wall0,
+        'collect_cpu_sec': time.process_time() - cpu0,
+        'fired': [x.name for x in fired],
+        'num_killed': 0,
+    }
+
+    # processes of all plans are killed together
+    pids = list()
+    create_times = list()
+    for _, _, planned, _ in plans:
+        pids.extend(planned['pid'].tolist())
+        create_times.extend(
+            planned['create_time'].tolist() 
+            if 'create_time' in planned.columns else 
+            [None] * planned.shape[0]
+        )
+    kill_results = (
+        kill_func(pids, timeout=kill_timeout, create_times=create_times)
+        if len(pids) > 0 else
+        pd.DataFrame(columns=utils.KILL_RESULT_COLUMNS)
+    )
+    overhead['num_killed'] = len(pids)
+
+    snapshot_after = (make_snapshot() if len(plans) > 0 else None)
+    for policy, user, planned, summary in plans:
+        killed_procs = planned.merge(kill_results, on='pid', how='left')
+        for rowdict in killed_procs.to_dict(orient='records'):
+            print(f'Policy {policy.name}: killed a process: {rowdict}')
+        summary = policy.verify(killed_procs, summary, snapshot_after)
+        summary.update(policy=policy.name, user=user)
+        summary.update(overhead)
+        print(f'Policy {policy.name}: summary: {summary}')
+        if logdir is not None:
+            utils.write_log(killed_procs, logdir, summary=summary)
+
+    overhead['tick_wall_sec'] = time.perf_counter() - wall0
+    overhead['tick_cpu_sec'] = time.process_time() - cpu0
+    return overhead
+
+
+def monitor(logdir, policies='memory,cpu', tick_interval=5, kill_timeout=5, **kwargs):
+    """Args:
+        policies: Comma-separated string or list of policy names
+        kwargs: Passed to "make_policies"
+    """
+    if isinstance(policies, str):
+        policies = policies.split(',')
+    hostname = socket.gethostname()
+    policies = make_policies(policies, **kwargs)
+    rate_sampler = psutil_funcs.RateSampler()
+    make_snapshot = functools.partial(TickSnapshot, rate_sampler)
+    # stderr of a remote monitor is not kept (e.g. by the ssh agent), so 
+    # tick lines are also appended to a file next to the kill logs
+    host_logdir = os.path.join(logdir, hostname)
+    os.makedirs(host_logdir, exist_ok=True)
+    tick_logpath = os.path.join(host_logdir, 'ticks.log')
+    # pcpu is computed against the previous reading of "rate_sampler"
+    record_cputimes = any(isinstance(x, CPUPolicy) for x in policies)
+    while True:
+        overhead = run_tick(policies, make_snapshot, logdir, kill_timeout=kill_timeout)
+        utils.print_timestamp(
+            f'{hostname}: tick overhead: '
+            f'wall {overhead["tick_wall_sec"]:.3f} s, cpu {overhead["tick_cpu_sec"]:.3f} s; '
+            f'fired policies: {overhead["fired"]}',
+            files=[tick_logpath],
+        )
+        # cpu times are recorded every tick, so that pcpu at kill time 
+        # covers the last tick interval
+        if record_cputimes:
+            rate_sampler.sample(list(psutil.process_iter()), IO=False)
+        time.sleep(tick_interval)
+
+
+def main():
+    args = argument_parsing()
+    os.makedirs(args.logdir, exist_ok=True)
+
+    kwargs = vars(args)
+    nodes = kwargs.pop('nodes')
+    utils.run_over_nodes(nodes, monitor, kwargs=kwargs)
+
+
+if __name__ == '__main__':
+    main()
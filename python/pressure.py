@@ -0,0 +1,161 @@
+"""Pressure stall information (PSI) from /proc/pressure.
+
+A PressureWatcher registers a PSI trigger and sleeps in poll() until the
+kernel reports that stall time within a window exceeded a threshold, so a
+watchdog can wake immediately on pressure without polling frequently.
+If triggers are not available (no PSI support, no permission, or a fixture
+directory given as "pressure_root"), avg10 is read periodically instead.
+"""
+
+import os
+import time
+import select
+
+
+PRESSURE_ROOT = '/proc/pressure'
+PRESSURE_KINDS = ('some', 'full')
+
+
+def read_pressure(resource, pressure_root=PRESSURE_ROOT):
+    """Returns a dict like {'some': {'avg10': .., 'avg60': .., 'avg300': ..,
+    'total': ..}, 'full': {...}}. "total" is in microseconds.
+
+    Args:
+        resource: "cpu", "memory" or "io"
+    """
+    result = dict()
+    with open(os.path.join(pressure_root, resource)) as f:
+        for line in f:
+            linesp = line.split()
+            if len(linesp) == 0:
+                continue
+            fields = dict(x.split('=') for x in linesp[1:])
+            result[linesp[0]] = {
+                'avg10': float(fields['avg10']),
+                'avg60': float(fields['avg60']),
+                'avg300': float(fields['avg300']),
+                'total': int(fields['total']),
+            }
+    return result
+
+
+class PressureWatcher:
+    """Args:
+        resource: "cpu", "memory" or "io"
+        stall_ms, window_ms: The trigger fires when tasks have been stalled
+            for "stall_ms" within any "window_ms" window. Unprivileged users
+            need "window_ms" to be a multiple of 2000.
+        kind: "some" or "full"
+        use_trigger: If None, triggers are used only with the real
+            /proc/pressure.
+        fallback_interval: Seconds between reads of the pressure file when
+            triggers are not used. avg10 is then compared with the
+            percentage stall_ms / window_ms.
+    """
+
+    def __init__(
+        self,
+        resource,
+        stall_ms=150,
+        window_ms=1000,
+        kind='some',
+        pressure_root=PRESSURE_ROOT,
+        use_trigger=None,
+        fallback_interval=1,
+    ):
+        if kind not in PRESSURE_KINDS:
+            raise Exception(f'"kind" must be one of {PRESSURE_KINDS}')
+        if use_trigger is None:
+            use_trigger = (pressure_root == PRESSURE_ROOT)
+
+        self.resource = resource
+        self.kind = kind
+        self.pressure_root = pressure_root
+        self.threshold_pct = 100 * stall_ms / window_ms
+        self.fallback_interval = fallback_interval
+        self.fd = None
+        self.poller = None
+
+        if use_trigger:
+            self.register_trigger(stall_ms, window_ms)
+
+    def register_trigger(self, stall_ms, window_ms):
+        path = os.path.join(self.pressure_root, self.resource)
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        except OSError as exc:
+            print(f'Failed to open {repr(path)} ({exc}); falling back to reading avg10')
+            return
+        try:
+            os.write(fd, f'{self.kind} {stall_ms * 1000} {window_ms * 1000}\0'.encode())
+        except OSError as exc:
+            os.close(fd)
+            print(f'Failed to register a PSI trigger on {repr(path)} ({exc}); falling back to reading avg10')
+            return
+
+        self.fd = fd
+        self.poller = select.poll()
+        self.poller.register(fd, select.POLLPRI)
+
+    @property
+    def uses_trigger(self):
+        return self.fd is not None
+
+    def is_over_threshold(self):
+        pressure = read_pressure(self.resource, self.pressure_root)
+        return pressure[self.kind]['avg10'] >= self.threshold_pct
+
+    def wait(self, timeout):
+        """Returns True as soon as the threshold is crossed, or False after
+        "timeout" seconds without crossing.
+        """
+        if self.uses_trigger:
+            for fd, event in self.poller.poll(timeout * 1000):
+                if event & select.POLLERR:
+                    raise Exception(f'PSI trigger on {self.resource} is no longer valid')
+                if event & select.POLLPRI:
+                    return True
+            return False
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                if self.is_over_threshold():
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(self.fallback_interval, remaining))
+
+    def close(self):
+        if self.fd is not None:
+            self.poller.unregister(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            self.poller = None
+
+
+def wait_for_next_check(watcher, interval, last_check, min_gap):
+    """Waits until the next check of a watchdog loop. Returns True if woken
+    by pressure.
+
+    Under sustained pressure a trigger fires every window, so after a wake
+    this does not return before "min_gap" seconds have passed since
+    "last_check" (a time.monotonic() value).
+
+    Args:
+        watcher: A PressureWatcher, or None to sleep "interval" seconds
+    """
+    if watcher is None:
+        time.sleep(interval)
+        return False
+    woken = watcher.wait(interval)
+    if woken:
+        time.sleep(max(last_check + min_gap - time.monotonic(), 0))
+    return woken
+
+
+def describe_wait(watcher, interval, min_gap):
+    if watcher is None:
+        return f'Sleeping for {interval} seconds'
+    else:
+        return f'Waiting up to {interval} seconds for a PSI trigger (at least {min_gap} seconds between checks)'
@@ -0,0 +1,335 @@
+"""Process information read directly from /proc, without running "ps"."""
+
+import os
+import pwd
+import time
+import functools
+import collections
+
+import numpy as np
+import pandas as pd
+
+
+PROC_ROOT = '/proc'
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+
+# 0-based indexes of /proc/<pid>/stat fields following the "(comm)" field
+STAT_STATE = 0
+STAT_UTIME = 11
+STAT_STIME = 12
+STAT_NUM_THREADS = 17
+STAT_STARTTIME = 19
+STAT_RSS = 21
+
+PROC_DF_COLUMNS = ('pid', 'tid', 'state', 'user', 'pcpu', 'rss', 'cmd')
+
+
+###########
+# readers #
+###########
+
+def read_bytes(path):
+    """Returns None if the process has gone away or is not readable"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+
+
+def list_pids(proc_root=PROC_ROOT):
+    return sorted(int(x) for x in os.listdir(proc_root) if x.isdigit())
+
+
+def list_tids(pid, proc_root=PROC_ROOT):
+    try:
+        return sorted(int(x) for x in os.listdir(f'{proc_root}/{pid}/task'))
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return list()
+
+
+def parse_stat(data):
+    """Returns (comm, fields following comm).
+    comm may contain spaces and parentheses, so the last ')' is searched.
+    """
+    left, _, right = data.rpartition(b')')
+    comm = left.partition(b'(')[2].decode(errors='replace')
+    return comm, right.split()
+
+
+def read_stat(pid, tid=None, proc_root=PROC_ROOT):
+    if tid is None:
+        data = read_bytes(f'{proc_root}/{pid}/stat')
+    else:
+        data = read_bytes(f'{proc_root}/{pid}/task/{tid}/stat')
+
+    if data is None:
+        return None, None
+    else:
+        return parse_stat(data)
+
+
+def read_uid(pid, proc_root=PROC_ROOT):
+    """Returns the effective uid, which is what "ps -o user" shows"""
+    data = read_bytes(f'{proc_root}/{pid}/status')
+    if data is None:
+        return None
+    for line in data.split(b'\n'):
+        if line.startswith(b'Uid:'):
+            return int(line.split()[2])
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_username_by_uid(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+def read_cmd(pid, comm, proc_root=PROC_ROOT):
+    """Kernel threads have an empty cmdline; "ps" shows them as [comm]"""
+    data = read_bytes(f'{proc_root}/{pid}/cmdline')
+    if data is None:
+        return None
+    cmd = data.replace(b'\x00', b' ').strip().decode(errors='replace')
+    if cmd == '':
+        cmd = f'[{comm}]'
+    return cmd
+
+
+def read_uptime(proc_root=PROC_ROOT):
+    with open(f'{proc_root}/uptime') as f:
+        return float(f.read().split()[0])
+
+
+def lifetime_pcpu(stat_fields, uptime):
+    """CPU usage averaged over the lifetime of the process, like "ps -o pcpu" """
+    cputime = (int(stat_fields[STAT_UTIME]) + int(stat_fields[STAT_STIME])) / CLK_TCK
+    elapsed = uptime - (int(stat_fields[STAT_STARTTIME]) / CLK_TCK)
+    if elapsed <= 0:
+        return 0.0
+    else:
+        return round(100 * cputime / elapsed, 1)
+
+
+##########
+# memory #
+##########
+
+def read_smaps_rollup(pid, proc_root=PROC_ROOT):
+    """Returns a dict with "rss", "pss", "uss" and "swap" in bytes.
+
+    smaps_rollup is much cheaper than smaps, but still walks the whole
+    address space under the mm lock, so it should be read only for a few
+    processes at a time.
+    """
+    data = read_bytes(f'{proc_root}/{pid}/smaps_rollup')
+    if data is None:
+        return None
+
+    fields = dict()
+    for line in data.split(b'\n')[1:]:
+        linesp = line.split()
+        if len(linesp) >= 2:
+            fields[linesp[0].rstrip(b':')] = int(linesp[1]) * 1024
+
+    return {
+        'rss': fields.get(b'Rss'),
+        'pss': fields.get(b'Pss'),
+        'uss': fields.get(b'Private_Clean', 0) + fields.get(b'Private_Dirty', 0),
+        'swap': fields.get(b'Swap'),
+    }
+
+
+##############
+# collectors #
+##############
+
+THREAD_STATE_KEYS = ('R', 'D', 'S', 'Z')
+
+
+def count_thread_states(pids, proc_root=PROC_ROOT):
+    """Scans /proc/<pid>/task/*/stat once for each process.
+
+    Returns:
+        A dict mapping each of THREAD_STATE_KEYS to an int64 array aligned
+        with "pids", holding the number of threads in that state. Vanished
+        processes get zeros.
+    """
+    counts = dict(
+        (key, np.zeros(len(pids), dtype=np.int64)) for key in THREAD_STATE_KEYS
+    )
+    for idx, pid in enumerate(pids):
+        for tid in list_tids(pid, proc_root):
+            data = read_bytes(f'{proc_root}/{pid}/task/{tid}/stat')
+            if data is None:
+                continue
+            # the state is the first field after "(comm)"
+            state_pos = data.rindex(b')') + 2
+            state = data[state_pos:(state_pos + 1)].decode()
+            if state in counts:
+                counts[state][idx] += 1
+    return counts
+
+
+def read_proc_df(format_names=None, include_threads=False, proc_root=PROC_ROOT):
+    """Drop-in replacement for "utils.run_ps_read_with_pandas".
+
+    Returns a DataFrame with the same columns, dtypes and row layout as the
+    output of "ps -A" (or "ps -mA" if "include_threads" is True): a process
+    row followed by one row for each of its threads. Only the files needed
+    for "format_names" are read.
+    """
+    if format_names is None:
+        format_names = PROC_DF_COLUMNS
+    format_names = tuple(format_names)
+    unknown = set(format_names).difference(PROC_DF_COLUMNS)
+    if len(unknown) > 0:
+        raise Exception(f'Unknown format names: {unknown}')
+
+    need_stat = any(x in format_names for x in ('state', 'pcpu', 'rss', 'cmd'))
+    uptime = (read_uptime(proc_root) if ('pcpu' in format_names) else None)
+
+    # enumerate rows first so that columns can be preallocated
+    pids = list_pids(proc_root)
+    if include_threads:
+        row_tids = [list_tids(pid, proc_root) for pid in pids]
+        nrow = len(pids) + sum(len(x) for x in row_tids)
+    else:
+        row_tids = None
+        nrow = len(pids)
+
+    pid_col = np.zeros(nrow, dtype=np.int64)
+    tid_col = np.zeros(nrow, dtype=np.int64)
+    is_leader = np.zeros(nrow, dtype=bool)
+    state_col = np.full(nrow, None, dtype=object)
+    user_col = np.full(nrow, None, dtype=object)
+    pcpu_col = np.full(nrow, np.nan, dtype=np.float64)
+    rss_col = np.zeros(nrow, dtype=np.int64)
+    cmd_col = np.full(nrow, None, dtype=object)
+    valid = np.ones(nrow, dtype=bool)
+
+    idx = 0
+    for pid_idx, pid in enumerate(pids):
+        comm, fields = (read_stat(pid, proc_root=proc_root) if need_stat else (None, None))
+        if 'user' in format_names:
+            uid = read_uid(pid, proc_root)
+            user = (None if uid is None else get_username_by_uid(uid))
+        else:
+            uid = user = None
+        tids = (row_tids[pid_idx] if include_threads else list())
+
+        # process vanished
+        if (need_stat and fields is None) or ('user' in format_names and uid is None):
+            valid[idx:(idx + 1 + len(tids))] = False
+            idx += 1 + len(tids)
+            continue
+
+        # process row
+        pid_col[idx] = pid
+        tid_col[idx] = pid
+        is_leader[idx] = True
+        user_col[idx] = user
+        if not include_threads:
+            state_col[idx] = fields[STAT_STATE].decode() if need_stat else None
+        if 'pcpu' in format_names:
+            pcpu_col[idx] = lifetime_pcpu(fields, uptime)
+        if 'rss' in format_names:
+            rss_col[idx] = int(fields[STAT_RSS]) * PAGESIZE // 1024
+        if 'cmd' in format_names:
+            cmd_col[idx] = read_cmd(pid, comm, proc_root)
+        idx += 1
+
+        # thread rows
+        for tid in tids:
+            if need_stat:
+                _, tfields = read_stat(pid, tid, proc_root=proc_root)
+                if tfields is None:
+                    valid[idx] = False
+                    idx += 1
+                    continue
+                state_col[idx] = tfields[STAT_STATE].decode()
+                if 'pcpu' in format_names:
+                    pcpu_col[idx] = lifetime_pcpu(tfields, uptime)
+            tid_col[idx] = tid
+            user_col[idx] = user
+            idx += 1
+
+    # make df
+    columns = {
+        'pid': pd.arrays.IntegerArray(pid_col, ~is_leader),
+        'tid': pd.arrays.IntegerArray(tid_col, (is_leader if include_threads else ~is_leader)),
+        'state': pd.array(state_col, dtype=pd.StringDtype()),
+        'user': pd.array(user_col, dtype=pd.StringDtype()),
+        'pcpu': pd.array(pcpu_col, dtype=pd.Float64Dtype()),
+        'rss': pd.arrays.IntegerArray(rss_col, ~is_leader),
+        'cmd': pd.array(cmd_col, dtype=pd.StringDtype()),
+    }
+    df = pd.DataFrame({key: columns[key] for key in format_names})
+    df = df.loc[valid, :].reset_index(drop=True)
+
+    return df
+
+
+########
+# load #
+########
+
+def read_run_queue(proc_root=PROC_ROOT):
+    """Returns (procs_running, procs_blocked) from /proc/stat.
+    These are the numbers of threads in R and D state, respectively.
+    """
+    running = blocked = None
+    with open(f'{proc_root}/stat', 'rb') as f:
+        for line in f:
+            if line.startswith(b'procs_running '):
+                running = int(line.split()[1])
+            elif line.startswith(b'procs_blocked '):
+                blocked = int(line.split()[1])
+                break
+    return running, blocked
+
+
+def read_loadavg(proc_root=PROC_ROOT):
+    """Returns 1, 5 and 15 minute load averages"""
+    with open(f'{proc_root}/loadavg') as f:
+        return tuple(float(x) for x in f.read().split()[:3])
+
+
+class LoadSampler:
+    """Keeps the latest "window" samples of the number of R and D threads.
+
+    Each sample reads only /proc/stat, so sampling is cheap enough to be done
+    at sub-second intervals on an overloaded node.
+    """
+
+    def __init__(self, window=3, proc_root=PROC_ROOT):
+        self.proc_root = proc_root
+        self.samples = collections.deque(maxlen=window)
+
+    def sample(self):
+        running, blocked = read_run_queue(self.proc_root)
+        load = running + blocked
+        self.record(load)
+        return load
+
+    def record(self, load, timestamp=None):
+        """Adds a load value obtained elsewhere"""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.samples.append((timestamp, load))
+
+    def is_full(self):
+        return len(self.samples) == self.samples.maxlen
+
+    def mean(self):
+        """NaN if there are no samples yet"""
+        if len(self.samples) == 0:
+            return np.nan
+        return sum(x[1] for x in self.samples) / len(self.samples)
+
+    def loadavg(self):
+        return read_loadavg(self.proc_root)
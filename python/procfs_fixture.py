@@ -0,0 +1,341 @@
+"""Generates a synthetic /proc tree for benchmarking and regression-testing
+the collectors without a busy node.
+
+The tree has the files read by procfs, psutil_funcs and procsnapshot:
+per-process stat, status, statm, smaps_rollup, io, cmdline and task/<tid>/stat,
+and top-level stat, uptime, loadavg and meminfo. Output is deterministic for
+a given seed.
+
+Usage: python procfs_fixture.py --out /tmp/fakeproc --num-procs 30000 --threads-per-proc 6.7
+"""
+
+import os
+import argparse
+
+import numpy as np
+
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+UPTIME = 864000.0  # 10 days
+BOOT_TIME = 1700000000
+MEMTOTAL_KB = 512 * 1024**2  # 512 GiB
+
+FIRST_PID = 1000
+FIRST_UID = 10000
+STATE_NAMES = {'R': 'running', 'S': 'sleeping', 'D': 'disk sleep', 'Z': 'zombie'}
+COMMANDS = [
+    ('python', ['python', 'run_pipeline.py', '--threads', '8']),
+    ('R', ['/usr/lib/R/bin/exec/R', '--no-echo', '--file=analysis.R']),
+    ('java', ['java', '-Xmx16g', '-jar', 'gatk.jar', 'HaplotypeCaller']),
+    ('bwa', ['bwa', 'mem', '-t', '16', 'ref.fa', 'reads_1.fq.gz', 'reads_2.fq.gz']),
+    ('bash', ['-bash']),
+    ('sshd', ['sshd: user@pts/0']),
+    ('jupyter-lab', ['/usr/bin/python3', '/usr/local/bin/jupyter-lab', '--no-browser']),
+    ('samtools', ['samtools', 'sort', '-@', '4', '-o', 'out.bam', 'in.bam']),
+]
+
+
+def argument_parsing():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--out',
+        help=f'Directory to be used as a fake /proc. Must not exist.',
+        required=True,
+        dest='out',
+    )
+    parser.add_argument(
+        '--num-procs',
+        help=f'The number of processes',
+        default=1000,
+        type=int,
+        dest='num_procs',
+    )
+    parser.add_argument(
+        '--threads-per-proc',
+        help=f'Mean number of threads per process',
+        default=4,
+        type=float,
+        dest='threads_per_proc',
+    )
+    parser.add_argument(
+        '--num-users',
+        help=f'The number of users owning the processes (besides root)',
+        default=20,
+        type=int,
+        dest='num_users',
+    )
+    parser.add_argument(
+        '--running-fraction',
+        help=f'Fraction of threads in R state',
+        default=0.05,
+        type=float,
+        dest='running_fraction',
+    )
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        dest='seed',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+###########
+# writers #
+###########
+
+def write_file(path, content):
+    with open(path, 'wt') as f:
+        f.write(content)
+
+
+def make_stat(pid, comm, state, ppid, utime, stime, num_threads, starttime, vsize, rss_pages):
+    """52 fields, as in Linux 5.x"""
+    fields = [0] * 50
+    fields[0] = state
+    fields[1] = ppid
+    fields[2] = pid  # pgrp
+    fields[3] = pid  # session
+    fields[11] = utime
+    fields[12] = stime
+    fields[15] = 20  # priority
+    fields[17] = num_threads
+    fields[19] = starttime
+    fields[20] = vsize
+    fields[21] = rss_pages
+    fields[22] = 18446744073709551615  # rsslim
+    return f'{pid} ({comm}) ' + ' '.join(str(x) for x in fields) + '\n'
+
+
+def make_status(pid, comm, state, ppid, uid, num_threads, vmrss_kb):
+    return (
+        f'Name:\t{comm}\n'
+        f'State:\t{state} ({STATE_NAMES[state]})\n'
+        f'Tgid:\t{pid}\n'
+        f'Pid:\t{pid}\n'
+        f'PPid:\t{ppid}\n'
+        f'Uid:\t{uid}\t{uid}\t{uid}\t{uid}\n'
+        f'Gid:\t{uid}\t{uid}\t{uid}\t{uid}\n'
+        f'VmRSS:\t{vmrss_kb} kB\n'
+        f'Threads:\t{num_threads}\n'
+        f'voluntary_ctxt_switches:\t{pid * 7}\n'
+        f'nonvoluntary_ctxt_switches:\t{pid * 3}\n'
+    )
+
+
+def make_smaps_rollup(rss_kb, shared_kb):
+    private_kb = rss_kb - shared_kb
+    # shared pages are assumed to be shared with 4 processes
+    pss_kb = private_kb + shared_kb // 4
+    return (
+        f'00400000-7ffc00000000 ---p 00000000 00:00 0                          [rollup]\n'
+        f'Rss:            {rss_kb} kB\n'
+        f'Pss:            {pss_kb} kB\n'
+        f'Pss_Anon:       {private_kb} kB\n'
+        f'Pss_File:       {shared_kb // 4} kB\n'
+        f'Pss_Shmem:      0 kB\n'
+        f'Shared_Clean:   {shared_kb} kB\n'
+        f'Shared_Dirty:   0 kB\n'
+        f'Private_Clean:  0 kB\n'
+        f'Private_Dirty:  {private_kb} kB\n'
+        f'Referenced:     {rss_kb} kB\n'
+        f'Anonymous:      {private_kb} kB\n'
+        f'LazyFree:       0 kB\n'
+        f'AnonHugePages:  0 kB\n'
+        f'ShmemPmdMapped: 0 kB\n'
+        f'FilePmdMapped:  0 kB\n'
+        f'Shared_Hugetlb: 0 kB\n'
+        f'Private_Hugetlb: 0 kB\n'
+        f'Swap:           0 kB\n'
+        f'SwapPss:        0 kB\n'
+        f'Locked:         0 kB\n'
+    )
+
+
+def make_io(read_bytes, write_bytes):
+    return (
+        f'rchar: {read_bytes * 2}\n'
+        f'wchar: {write_bytes * 2}\n'
+        f'syscr: {read_bytes // 4096}\n'
+        f'syscw: {write_bytes // 4096}\n'
+        f'read_bytes: {read_bytes}\n'
+        f'write_bytes: {write_bytes}\n'
+        f'cancelled_write_bytes: 0\n'
+    )
+
+
+def make_system_stat(ncpu, procs_running, procs_blocked, num_procs):
+    total_ticks = int(UPTIME * CLK_TCK)
+    cpu_line = lambda name, n: (
+        f'{name} {total_ticks * n // 4} 0 {total_ticks * n // 10} '
+        f'{total_ticks * n // 2} {total_ticks * n // 50} 0 0 0 0 0\n'
+    )
+    return (
+        cpu_line('cpu ', ncpu)
+        + ''.join(cpu_line(f'cpu{x}', 1) for x in range(ncpu))
+        + f'intr 0\n'
+        + f'ctxt 0\n'
+        + f'btime {BOOT_TIME}\n'
+        + f'processes {num_procs}\n'
+        + f'procs_running {procs_running}\n'
+        + f'procs_blocked {procs_blocked}\n'
+        + f'softirq 0 0 0 0 0 0 0 0 0 0 0\n'
+    )
+
+
+def make_meminfo(used_kb):
+    free_kb = max(MEMTOTAL_KB - used_kb, 0)
+    lines = [
+        ('MemTotal', MEMTOTAL_KB),
+        ('MemFree', free_kb // 2),
+        ('MemAvailable', free_kb),
+        ('Buffers', 0),
+        ('Cached', free_kb // 2),
+        ('SwapCached', 0),
+        ('Active', used_kb),
+        ('Inactive', free_kb // 2),
+        ('SwapTotal', 0),
+        ('SwapFree', 0),
+        ('Shmem', 0),
+        ('SReclaimable', 0),
+        ('Slab', 0),
+    ]
+    return ''.join(f'{key}:{val:>16} kB\n' for key, val in lines)
+
+
+#############
+# generator #
+#############
+
+def generate(
+    outdir,
+    num_procs=1000,
+    threads_per_proc=4,
+    num_users=20,
+    running_fraction=0.05,
+    blocked_fraction=0.005,
+    ncpu=64,
+    seed=0,
+):
+    """Writes a fake /proc tree to "outdir". Processes are owned by root
+    and "num_users" users with uids from FIRST_UID, in a Zipf-like
+    distribution. Thread counts are geometric with mean "threads_per_proc".
+
+    Returns:
+        A dict with the numbers of processes and threads and the total
+        numbers of R and D threads.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(outdir, exist_ok=False)
+
+    pids = FIRST_PID + np.arange(num_procs) * 3
+    user_weights = 1 / np.arange(1, num_users + 2)
+    uid_choices = np.concatenate([[0], FIRST_UID + np.arange(num_users)])
+    uids = rng.choice(uid_choices, size=num_procs, p=(user_weights / user_weights.sum()))
+    num_threads = rng.geometric(1 / max(threads_per_proc, 1), size=num_procs)
+    command_idxs = rng.integers(len(COMMANDS), size=num_procs)
+    rss_kb = (rng.lognormal(mean=10, sigma=2, size=num_procs).astype(np.int64) // 4 + 1) * 4
+    shared_kb = (rss_kb * rng.uniform(0, 0.5, size=num_procs)).astype(np.int64)
+    starttimes = rng.integers(0, int(UPTIME * CLK_TCK * 0.9), size=num_procs)
+    cpu_fraction = rng.beta(0.5, 5, size=num_procs)
+
+    num_running = num_blocked = 0
+    next_tid = FIRST_PID + num_procs * 3
+    for idx in range(num_procs):
+        pid = int(pids[idx])
+        uid = int(uids[idx])
+        comm, cmdline = COMMANDS[command_idxs[idx]]
+        lifetime_ticks = int(UPTIME * CLK_TCK) - int(starttimes[idx])
+        cputicks = int(lifetime_ticks * cpu_fraction[idx] * num_threads[idx])
+        utime = cputicks * 9 // 10
+        stime = cputicks - utime
+        rss_pages = int(rss_kb[idx]) * 1024 // PAGESIZE
+
+        # thread states; the leader's state is that of its first thread
+        states = rng.choice(
+            ['R', 'D', 'S'],
+            size=int(num_threads[idx]),
+            p=[running_fraction, blocked_fraction, 1 - running_fraction - blocked_fraction],
+        )
+        num_running += int((states == 'R').sum())
+        num_blocked += int((states == 'D').sum())
+
+        procdir = os.path.join(outdir, str(pid))
+        os.makedirs(os.path.join(procdir, 'task'))
+        stat = make_stat(
+            pid, comm, states[0], 1, utime, stime, int(num_threads[idx]),
+            int(starttimes[idx]), int(rss_kb[idx]) * 4096, rss_pages,
+        )
+        write_file(os.path.join(procdir, 'stat'), stat)
+        write_file(
+            os.path.join(procdir, 'status'),
+            make_status(pid, comm, states[0], 1, uid, int(num_threads[idx]), int(rss_kb[idx])),
+        )
+        write_file(
+            os.path.join(procdir, 'statm'),
+            f'{rss_pages * 4} {rss_pages} {int(shared_kb[idx]) * 1024 // PAGESIZE} 1 0 {rss_pages} 0\n',
+        )
+        write_file(
+            os.path.join(procdir, 'smaps_rollup'),
+            make_smaps_rollup(int(rss_kb[idx]), int(shared_kb[idx])),
+        )
+        write_file(
+            os.path.join(procdir, 'io'),
+            make_io(int(rss_kb[idx]) * 1024 * 8, int(rss_kb[idx]) * 1024 * 2),
+        )
+        write_file(os.path.join(procdir, 'cmdline'), '\0'.join(cmdline) + '\0')
+
+        # threads
+        for thread_idx, state in enumerate(states):
+            if thread_idx == 0:
+                tid = pid
+            else:
+                tid = next_tid
+                next_tid += 1
+            taskdir = os.path.join(procdir, 'task', str(tid))
+            os.makedirs(taskdir)
+            tstat = make_stat(
+                tid, comm, state, 1, utime // len(states), stime // len(states),
+                int(num_threads[idx]), int(starttimes[idx]), int(rss_kb[idx]) * 4096, rss_pages,
+            )
+            write_file(os.path.join(taskdir, 'stat'), tstat)
+
+    # system-wide files
+    write_file(os.path.join(outdir, 'uptime'), f'{UPTIME:.2f} {UPTIME * ncpu * 0.5:.2f}\n')
+    write_file(
+        os.path.join(outdir, 'stat'),
+        make_system_stat(ncpu, num_running, num_blocked, num_procs),
+    )
+    load = num_running + num_blocked
+    write_file(
+        os.path.join(outdir, 'loadavg'),
+        f'{load:.2f} {load:.2f} {load:.2f} {num_running}/{int(num_threads.sum())} {next_tid}\n',
+    )
+    write_file(os.path.join(outdir, 'meminfo'), make_meminfo(int(rss_kb.sum())))
+
+    return {
+        'num_procs': num_procs,
+        'num_threads': int(num_threads.sum()),
+        'procs_running': num_running,
+        'procs_blocked': num_blocked,
+    }
+
+
+def main():
+    args = argument_parsing()
+    summary = generate(
+        args.out,
+        num_procs=args.num_procs,
+        threads_per_proc=args.threads_per_proc,
+        num_users=args.num_users,
+        running_fraction=args.running_fraction,
+        seed=args.seed,
+    )
+    print(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 import collections
+import collections.abc
+import functools
 import multiprocessing
 import socket
 
@@ -7,11 +9,14 @@ import pandas as pd
 
 import utils
 import psutil_funcs
+import procfs
+import spans
 
 
 SNAPSHOT_DF_KEYS = [
     'hostname',
     'user',
+    'pid',
 
     'pcpu_user',
     'pcpu_system',
@@ -72,37 +77,154 @@ class ProcessInfo(collections.UserDict):
         super().__setitem__(key, val)
 
 
+# keys of the "thread_states" dict, as set by "psutil_funcs.into_procinfo_noncpu"
+THREAD_STATES_VIEW_KEYS = procfs.THREAD_STATE_KEYS + ('RD',)
+
+
+def is_missing(val):
+    return (
+        (val is None) 
+        or (val is pd.NA) 
+        or (isinstance(val, float) and np.isnan(val))
+    )
+
+
+class ProcessInfoView(collections.abc.MutableMapping):
+    """Dict-style access to one row of a ProcessSnapshot, with the same keys
+    as ProcessInfo. Reads and writes go to the snapshot columns.
+    """
+
+    __slots__ = ('snapshot', 'idx')
+
+    def __init__(self, snapshot, idx):
+        self.snapshot = snapshot
+        self.idx = idx
+
+    def check_key(self, key):
+        if key not in ProcessInfo.allowed_keys: 
+            raise Exception(f'Allowed keys: {ProcessInfo.allowed_keys}')
+
+    def __getitem__(self, key):
+        self.check_key(key)
+        if key == 'thread_states':
+            if 'num_RD' not in self.snapshot.columns:
+                return pd.NA
+            return dict(
+                (x, self.snapshot.columns[f'num_{x}'][self.idx])
+                for x in THREAD_STATES_VIEW_KEYS
+            )
+        try:
+            return self.snapshot.columns[key][self.idx]
+        except KeyError:
+            return pd.NA
+
+    def __setitem__(self, key, val):
+        """"thread_states" is stored in the "num_*" columns. pd.NA and None
+        are stored as NaN in numeric columns; integer columns become float.
+        """
+        self.check_key(key)
+        if key == 'thread_states':
+            if is_missing(val):
+                for x in THREAD_STATES_VIEW_KEYS:
+                    self.set_value(f'num_{x}', np.nan)
+            else:
+                val = dict(val)
+                val.setdefault('RD', val['R'] + val['D'])
+                for x in THREAD_STATES_VIEW_KEYS:
+                    self.set_value(f'num_{x}', val[x])
+        else:
+            self.set_value(key, val)
+
+    def set_value(self, key, val):
+        columns = self.snapshot.columns
+        if key not in columns:
+            columns[key] = np.full(self.snapshot.num_procs, pd.NA, dtype=object)
+        column = columns[key]
+        if (column.dtype.kind in 'iuf') and is_missing(val):
+            val = np.nan
+            if column.dtype.kind != 'f':
+                column = column.astype(float)
+        try:
+            column[self.idx] = val
+        except (TypeError, ValueError):
+            # e.g. a string into a numeric column
+            column = column.astype(object)
+            column[self.idx] = val
+        columns[key] = column
+
+    def __delitem__(self, key):
+        raise Exception(f'Keys cannot be deleted from a snapshot row')
+
+    def __iter__(self):
+        columns = self.snapshot.columns
+        return (
+            x for x in ProcessInfo.allowed_keys 
+            if (x in columns) or (x == 'thread_states' and 'num_RD' in columns)
+        )
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({dict(self)})'
+
+
 class ProcessSnapshot:
+    """Stores each field as a numpy array ("columns"), aligned with 
+    "psutil_procs". Missing values of numeric columns are NaN.
+    """
+
     @classmethod
-    def from_psutil(cls, pcpu=True, IO=True, interval=0.2):
+    def from_psutil(cls, pcpu=True, IO=True, interval=0.2, sampler=None):
+        """Args:
+            sampler: A psutil_funcs.RateSampler. If given, rates are computed
+                against the previous snapshot taken with the same sampler and
+                "interval" is slept only when there is no previous snapshot.
+        """
         result = cls()
-        result.psutil_procs = list(
-            psutil_funcs.run_process_iter(root=utils.check_root())
-        )
-        result.set_procinfos_psutil(
-            pcpu=pcpu, IO=IO, interval=interval,
+        with spans.span('snapshot.enumerate'):
+            result.psutil_procs = list(
+                psutil_funcs.run_process_iter(root=utils.check_root())
+            )
+        result.set_columns_psutil(
+            pcpu=pcpu, IO=IO, interval=interval, sampler=sampler,
         )
         result.set_df()
         return result
 
-    def set_procinfos_psutil(self, pcpu=True, IO=True, interval=0.2):
-        self.procinfos = list()
-        self.procinfos.extend(
-            (
-                ProcessInfo(psutil_funcs.into_procinfo_noncpu(proc)) 
-                for proc in self.psutil_procs
-            )
-        )
+    @property
+    def num_procs(self):
+        return len(self.psutil_procs)
+
+    @property
+    def procinfos(self):
+        """Lightweight dict-style row views"""
+        return [ProcessInfoView(self, idx) for idx in range(self.num_procs)]
+
+    def set_columns_psutil(self, pcpu=True, IO=True, interval=0.2, sampler=None):
+        self.set_basic_columns()
+        self.add_thread_states()
         self.add_pcpu_io_with_psutil(
-            pcpu=pcpu, IO=IO, interval=interval,
+            pcpu=pcpu, IO=IO, interval=interval, sampler=sampler,
+        )
+
+    @spans.timed('snapshot.basic_columns')
+    def set_basic_columns(self):
+        procs = self.psutil_procs
+        self.columns = dict()
+        self.columns['hostname'] = np.full(self.num_procs, socket.gethostname(), dtype=object)
+        self.columns['pid'] = np.fromiter((x.pid for x in procs), dtype=np.int64, count=self.num_procs)
+        self.columns['user'] = make_object_array(x.info['username'] for x in procs)
+        self.columns['cmd'] = make_object_array(
+            ' '.join(x.info['cmdline'] or []) for x in procs
         )
+        self.columns['rss_bytes'] = get_meminfo_column(procs, 'rss')
+        self.columns['pss_bytes'] = get_meminfo_column(procs, 'pss')
 
+    @spans.timed('snapshot.set_df')
     def set_df(self):
-        df = pd.DataFrame.from_records(
-            [
-                {key: dic[key] for key in SNAPSHOT_DF_KEYS}
-                for dic in self.procinfos
-            ]
+        df = pd.DataFrame(
+            dict((key, self.columns[key]) for key in SNAPSHOT_DF_KEYS)
         )
 
         df['pss_GB'] = df['pss_bytes'] / 1024**3
@@ -116,8 +238,19 @@ class ProcessSnapshot:
 
         self.df = df
 
-    def add_pcpu_io_with_psutil(self, pcpu=True, IO=True, interval=0.2):
-        if pcpu and IO:
+    @spans.timed('snapshot.thread_states')
+    def add_thread_states(self):
+        counts = psutil_funcs.get_thread_state_counts(self.columns['pid'])
+        for key, val in counts.items():
+            self.columns[f'num_{key}'] = val
+
+    @spans.timed('snapshot.rates')
+    def add_pcpu_io_with_psutil(self, pcpu=True, IO=True, interval=0.2, sampler=None):
+        if sampler is not None:
+            pcpus, iorates = sampler.sample(
+                self.psutil_procs, pcpu=pcpu, IO=IO, prime_interval=interval,
+            )
+        elif pcpu and IO:
             pcpus, iorates = psutil_funcs.get_pcpus_iorates(self.psutil_procs, interval=interval)
         elif pcpu and (not IO):
             pcpus = psutil_funcs.get_pcpus(self.psutil_procs, interval=interval)
@@ -130,47 +263,51 @@ class ProcessSnapshot:
             iorates = None
 
         # assign pcpus
-        if pcpus is None:
-            for x in self.procinfos:
-                x['pcpu_user'] = pd.NA
-                x['pcpu_system'] = pd.NA
-                x['pcpu_iowait'] = pd.NA
-                x['pcpu_total'] = pd.NA
-        else:
-            for idx, x in enumerate(self.procinfos):
-                x['pcpu_user'] = pcpus['user'][idx]
-                x['pcpu_system'] = pcpus['system'][idx]
-                x['pcpu_iowait'] = pcpus['iowait'][idx]
-                try:
-                    x['pcpu_total'] = (
-                        x['pcpu_user']
-                        + x['pcpu_system']
-                        + x['pcpu_iowait']
-                    )
-                except:
-                    print(idx)
-                    print(pcpus['user'][idx])
-                    print(pcpus['system'][idx])
-                    print(pcpus['iowait'][idx])
-                    print(x['pcpu_user'])
-                    print(x['pcpu_system'])
-                    print(x['pcpu_iowait'])
-                    raise
-                        
+        for key in ('user', 'system', 'iowait'):
+            self.columns[f'pcpu_{key}'] = (
+                np.full(self.num_procs, np.nan) 
+                if pcpus is None else 
+                pcpus[key]
+            )
+        self.columns['pcpu_total'] = (
+            self.columns['pcpu_user']
+            + self.columns['pcpu_system']
+            + self.columns['pcpu_iowait']
+        )
 
         # assign iorates
-        if iorates is None:
-            for x in self.procinfos:
-                x['read B/s'] = pd.NA
-                x['write B/s'] = pd.NA
-                x['read B'] = pd.NA
-                x['write B'] = pd.NA
-        else:
-            for idx, x in enumerate(self.procinfos):
-                x['read B/s'] = iorates['read B/s'][idx]
-                x['write B/s'] = iorates['write B/s'][idx]
-                x['read B'] = iorates['read B'][idx]
-                x['write B'] = iorates['write B'][idx]
+        for key in ('read B/s', 'write B/s', 'read B', 'write B'):
+            self.columns[key] = (
+                np.full(self.num_procs, np.nan) 
+                if iorates is None else 
+                iorates[key]
+            )
+
+
+def make_object_array(iterable):
+    items = list(iterable)
+    result = np.empty(len(items), dtype=object)
+    result[:] = items
+    return result
+
+
+def get_meminfo_column(procs, attrname):
+    """NaN where the attribute is not available (e.g. "pss" without root)"""
+    result = np.full(len(procs), np.nan)
+    for idx, proc in enumerate(procs):
+        meminfo = proc.info.get('memory_full_info', proc.info.get('memory_info'))
+        if meminfo is not None:
+            result[idx] = getattr(meminfo, attrname, np.nan)
+    return result
+
+
+def make_empty_snapshot_df():
+    """A snapshot DataFrame with no rows, as returned when no node responded"""
+    snapshot = ProcessSnapshot()
+    snapshot.psutil_procs = list()
+    snapshot.columns = dict((key, np.zeros(0)) for key in SNAPSHOT_DF_KEYS)
+    snapshot.set_df()
+    return snapshot.df
 
 
 def get_snapshot_df_onenode_psutil(pcpu=True, IO=True, interval=0.2):
@@ -178,29 +315,243 @@ def get_snapshot_df_onenode_psutil(pcpu=True, IO=True, interval=0.2):
     return snapshot.df
 
 
-def get_snapshot_df_psutil(nodelist='all', pcpu=True, IO=True, interval=0.2):
-    if nodelist == 'current':
-        nodelist = [socket.gethostname()]
+def make_nodelist(nodelist):
+    """Args:
+        nodelist: 'current', 'all', or a list of hostnames. None is 'current'.
+    """
+    if (nodelist is None) or (nodelist == 'current'):
+        return [socket.gethostname()]
     elif nodelist == 'all':
-        nodelist = utils.ALL_NODES
+        return utils.ALL_NODES
     else:
-        nodelist = list(nodelist)
-
-    with multiprocessing.Pool() as pool:
-        argsiter = (
-            (
-                host, 
-                get_snapshot_df_onenode_psutil, 
-                [pcpu, IO, interval]
+        return list(nodelist)
+
+
+def get_snapshot_df_psutil(
+    nodelist='all', pcpu=True, IO=True, interval=0.2, use_agent=True, timeout=None,
+):
+    nodelist = make_nodelist(nodelist)
+    node_results = utils.run_over_nodes(
+        nodelist,
+        get_snapshot_df_onenode_psutil,
+        args=[pcpu, IO, interval],
+        use_agent=use_agent,
+        timeout=timeout,
+    )
+
+    node_results = [x for x in node_results if x is not None]
+    if len(node_results) == 0:
+        return make_empty_snapshot_df()
+    with spans.span('concat'):
+        return pd.concat(node_results, axis=0)
+
+
+get_snapshot_df = get_snapshot_df_psutil
+
+
+###############
+# aggregation #
+###############
+
+# An aggregation spec is a dict with keys:
+#   group_keys: columns to group by
+#   sum: columns summed within each group
+#   max: columns whose maximum is taken within each group
+#   topn: number of processes kept for each of "topn_by"
+#   topn_by: columns by which the largest processes are picked
+#   topn_columns: columns kept for the picked processes
+
+DEFAULT_AGGSPEC = {
+    'group_keys': ['hostname', 'user'],
+    'sum': [
+        'pcpu_user',
+        'pcpu_system',
+        'pcpu_iowait',
+        'pcpu_total',
+        'num_RD',
+        'rss_GB',
+        'pss_GB',
+        'read MB/s',
+        'write MB/s',
+    ],
+    'max': list(),
+    'topn': 5,
+    'topn_by': ['pcpu_total', 'pss_GB'],
+    'topn_columns': [
+        'hostname',
+        'pid',
+        'user',
+        'pcpu_total',
+        'num_RD',
+        'rss_GB',
+        'pss_GB',
+        'read MB/s',
+        'write MB/s',
+        'cmd',
+    ],
+}
+
+
+def get_agg_funcs(aggspec):
+    agg_funcs = dict((key, 'sum') for key in aggspec['sum'])
+    agg_funcs.update((key, 'max') for key in aggspec['max'])
+    return agg_funcs
+
+
+def make_topks(aggspec=DEFAULT_AGGSPEC):
+    return dict(
+        (key, utils.TopK(aggspec['topn'], key, columns=aggspec['topn_columns']))
+        for key in aggspec['topn_by']
+    )
+
+
+@spans.timed('snapshot.aggregate')
+def aggregate_snapshot_df(snapshot_df, aggspec=DEFAULT_AGGSPEC):
+    """Returns a dict:
+        grouped: DataFrame indexed by "group_keys"
+        top: dict mapping each of "topn_by" to a DataFrame of the largest processes
+    """
+    flat_df = snapshot_df.reset_index()
+    grouped = flat_df.groupby(aggspec['group_keys']).agg(get_agg_funcs(aggspec))
+    top = dict(
+        (key, topk.update(flat_df).result())
+        for key, topk in make_topks(aggspec).items()
+    )
+    return {'grouped': grouped, 'top': top}
+
+
+def merge_aggregates(aggregates, aggspec=DEFAULT_AGGSPEC):
+    """Merges the results of "aggregate_snapshot_df" from several nodes.
+    "aggregates" may be an iterator; top processes are updated as each 
+    aggregate arrives. If there are no aggregates (e.g. no node responded),
+    all tables are empty.
+    """
+    grouped_list = list()
+    topks = make_topks(aggspec)
+    for aggregate in aggregates:
+        grouped_list.append(aggregate['grouped'])
+        for key, topk in topks.items():
+            topk.update(aggregate['top'][key])
+
+    with spans.span('merge_aggregates'):
+        if len(grouped_list) == 0:
+            grouped = pd.DataFrame(
+                columns=list(get_agg_funcs(aggspec).keys()),
+                index=pd.MultiIndex.from_tuples([], names=aggspec['group_keys']),
             )
-            for host in nodelist
+        else:
+            grouped = pd.concat(
+                grouped_list, axis=0,
+            ).groupby(level=aggspec['group_keys']).agg(get_agg_funcs(aggspec))
+        top = dict(
+            (key, topk.result().reset_index(drop=True))
+            for key, topk in topks.items()
         )
-        node_results = pool.starmap(utils.run_over_ssh, argsiter)
+    return {'grouped': grouped, 'top': top}
 
-    return pd.concat(
-        [x for x in node_results if x is not None], 
-        axis=0,
+
+def get_snapshot_aggregate_onenode_psutil(aggspec=DEFAULT_AGGSPEC, pcpu=True, IO=True, interval=0.2):
+    snapshot = ProcessSnapshot.from_psutil(pcpu=pcpu, IO=IO, interval=interval)
+    return aggregate_snapshot_df(snapshot.df, aggspec)
+
+
+def get_snapshot_aggregate_psutil(
+    nodelist='all', 
+    aggspec=DEFAULT_AGGSPEC, 
+    pcpu=True, 
+    IO=True, 
+    interval=0.2, 
+    use_agent=True, 
+    timeout=None,
+):
+    """Like "get_snapshot_df_psutil", but each node returns only its grouped 
+    rows and top processes, which are merged here.
+    """
+    nodelist = make_nodelist(nodelist)
+    node_results = utils.iter_over_nodes(
+        nodelist,
+        get_snapshot_aggregate_onenode_psutil,
+        args=[aggspec, pcpu, IO, interval],
+        use_agent=use_agent,
+        timeout=timeout,
+    )
+    return merge_aggregates(
+        (x.result for x in node_results if x.result is not None), aggspec,
     )
 
 
-get_snapshot_df = get_snapshot_df_psutil
+get_snapshot_aggregate = get_snapshot_aggregate_psutil
+
+
+##########
+# report #
+##########
+
+class SnapshotReport:
+    """All views of a single cluster snapshot collection.
+
+    Either the full per-process table ("snapshot_df") or a pushed-down 
+    aggregate is collected once, and each view is computed from it only 
+    when first accessed.
+    """
+
+    def __init__(self, aggspec=DEFAULT_AGGSPEC, snapshot_df=None, aggregate=None):
+        if (snapshot_df is None) and (aggregate is None):
+            raise Exception(f'One of "snapshot_df" or "aggregate" must be given.')
+        self.aggspec = aggspec
+        self.snapshot_df = snapshot_df
+        self._aggregate = aggregate
+
+    @classmethod
+    def collect(
+        cls, 
+        nodelist='all', 
+        aggspec=DEFAULT_AGGSPEC, 
+        full=False, 
+        interval=0.2, 
+        use_agent=True, 
+        timeout=None,
+    ):
+        """Args:
+            full: If True, the whole per-process table is collected, which is 
+                required for "save". Otherwise only node-side aggregates are.
+        """
+        if full:
+            snapshot_df = get_snapshot_df(
+                nodelist=nodelist, interval=interval, use_agent=use_agent, timeout=timeout,
+            )
+            return cls(aggspec, snapshot_df=snapshot_df)
+        else:
+            aggregate = get_snapshot_aggregate(
+                nodelist=nodelist, aggspec=aggspec, interval=interval, use_agent=use_agent, timeout=timeout,
+            )
+            return cls(aggspec, aggregate=aggregate)
+
+    @functools.cached_property
+    def aggregate(self):
+        if self._aggregate is None:
+            return aggregate_snapshot_df(self.snapshot_df, self.aggspec)
+        else:
+            return self._aggregate
+
+    @functools.cached_property
+    def grouped(self):
+        return self.aggregate['grouped']
+
+    @functools.cached_property
+    def grouped_with_sum(self):
+        sum_row = self.grouped.sum(axis=0).to_frame(name='SUM').T
+        return pd.concat([self.grouped, sum_row], axis=0)
+
+    @functools.cached_property
+    def maxcpu(self):
+        return self.aggregate['top']['pcpu_total']
+
+    @functools.cached_property
+    def maxmem(self):
+        return self.aggregate['top']['pss_GB']
+
+    def save(self, path):
+        if self.snapshot_df is None:
+            raise Exception(f'Per-process table was not collected; use "full=True".')
+        self.snapshot_df.to_csv(path, sep='\t', header=True, index=True)
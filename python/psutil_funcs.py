@@ -25,11 +25,23 @@ import psutil
 import numpy as np
 import pandas as pd
 
+import procfs
+import spans
+
 
 RD_STATUSES = [psutil.STATUS_RUNNING, psutil.STATUS_DISK_SLEEP]
 
 
-def get_byuser_mem():
+def get_byuser_mem(tiered=False, topk_procs=10, topk_users=3, exclude_users=tuple()):
+    """Args:
+        tiered: If True, "memory_full_info" is not requested for every 
+            process. See "get_byuser_mem_tiered".
+    """
+    if tiered:
+        return get_byuser_mem_tiered(
+            topk_procs=topk_procs, topk_users=topk_users, exclude_users=exclude_users,
+        )
+
     df_data = list()
     for proc in psutil.process_iter(
         attrs=(
@@ -38,6 +50,10 @@ def get_byuser_mem():
             'username',
         ),
     ):
+        # not permitted to read
+        if proc.info['memory_full_info'] is None:
+            continue
+
         rowdict = dict()
         rowdict['pid'] = proc.pid
         rowdict['pss_bytes'] = proc.info['memory_full_info'].pss
@@ -45,7 +61,7 @@ def get_byuser_mem():
         rowdict['rss_bytes'] = proc.info['memory_full_info'].rss
         rowdict['rss_GB'] = round(rowdict['rss_bytes'] / 1024**3, 3)
         rowdict['user'] = proc.info['username']
-        rowdict['cmd'] = ' '.join(proc.info['cmdline'])
+        rowdict['cmd'] = ' '.join(proc.info['cmdline'] or [])
 
         df_data.append(rowdict)
 
@@ -57,6 +73,113 @@ def get_byuser_mem():
     return all_df, byuser_dfs
 
 
+def get_byuser_mem_tiered(topk_procs=10, topk_users=3, exclude_users=tuple()):
+    """First, RSS is read from statm for every process. Then PSS and USS are 
+    read from smaps_rollup only for the "topk_procs" processes with the 
+    largest RSS and for all processes of the "topk_users" users with the 
+    largest RSS sum. Other processes have NaN for PSS and USS.
+
+    Args:
+        exclude_users: Users never considered for PSS and USS (e.g. users
+            that will not be killed), so they do not take any of the slots.
+    """
+    proclist = list(psutil.process_iter(attrs=MEM_DF_ATTRS))
+    all_df = make_rss_df(proclist)
+
+    # select processes for smaps_rollup
+    candidates = ~all_df['user'].isin(exclude_users).to_numpy()
+    selected = np.zeros(all_df.shape[0], dtype=bool)
+    if topk_procs > 0:
+        candidate_idxs = np.flatnonzero(candidates)
+        order = np.argsort(-all_df['rss_bytes'].to_numpy()[candidate_idxs])
+        selected[candidate_idxs[order[:topk_procs]]] = True
+    if topk_users > 0:
+        top_users = (
+            all_df.loc[candidates, :]
+            .groupby('user')['rss_bytes'].sum()
+            .nlargest(topk_users).index
+        )
+        selected |= all_df['user'].isin(top_users).to_numpy()
+
+    add_smaps_rollup(all_df, selected)
+
+    byuser_dfs = dict(
+        (key, subdf) for key, subdf in all_df.groupby('user')
+    )
+
+    return all_df, byuser_dfs
+
+
+MEM_DF_ATTRS = ('memory_info', 'cmdline', 'username', 'create_time')
+
+
+def get_create_time_column(proclist):
+    """NaN where "create_time" is not in "info" or could not be read. Passed 
+    to "utils.kill_procs" to detect pid reuse.
+    """
+    return np.asarray(
+        [(np.nan if x.info.get('create_time') is None else x.info['create_time']) for x in proclist],
+        dtype=float,
+    )
+
+
+def make_rss_df(proclist):
+    """Args:
+        proclist: processes with "info" containing MEM_DF_ATTRS
+    """
+    proclist = [x for x in proclist if x.info['memory_info'] is not None]
+    return pd.DataFrame(
+        {
+            'pid': [x.pid for x in proclist],
+            'rss_bytes': [x.info['memory_info'].rss for x in proclist],
+            'user': [x.info['username'] for x in proclist],
+            'cmd': [' '.join(x.info['cmdline'] or []) for x in proclist],
+            'create_time': get_create_time_column(proclist),
+        }
+    )
+
+
+def add_smaps_rollup(all_df, selected):
+    """Adds PSS and USS columns, read only for rows where "selected" is True"""
+    pss = np.full(all_df.shape[0], np.nan)
+    uss = np.full(all_df.shape[0], np.nan)
+    for idx in np.flatnonzero(selected):
+        rollup = procfs.read_smaps_rollup(all_df['pid'].iat[idx], proc_root=psutil.PROCFS_PATH)
+        if rollup is not None:
+            pss[idx] = rollup['pss']
+            uss[idx] = rollup['uss']
+
+    all_df['pss_bytes'] = pss
+    all_df['uss_bytes'] = uss
+    all_df['pss_GB'] = (all_df['pss_bytes'] / 1024**3).round(3)
+    all_df['uss_GB'] = (all_df['uss_bytes'] / 1024**3).round(3)
+    all_df['rss_GB'] = (all_df['rss_bytes'] / 1024**3).round(3)
+    return all_df
+
+
+def get_processes(pids, attrs):
+    """Like "psutil.process_iter(attrs=attrs)", but only for "pids".
+    Processes which have gone away are skipped.
+    """
+    result = list()
+    for pid in pids:
+        try:
+            proc = psutil.Process(pid)
+            proc.info = proc.as_dict(attrs=attrs)
+        except psutil.NoSuchProcess:
+            continue
+        result.append(proc)
+    return result
+
+
+def get_procs_mem(pids):
+    """Returns a DataFrame with the columns of "get_byuser_mem_tiered", with 
+    PSS and USS read for every process in "pids".
+    """
+    all_df = make_rss_df(get_processes(pids, MEM_DF_ATTRS))
+    return add_smaps_rollup(all_df, np.ones(all_df.shape[0], dtype=bool))
+
+
 def get_cpu_usages(interval=0.2):
     result = list()
     for idx, x in enumerate(psutil.cpu_times_percent(interval=interval, percpu=True)):
@@ -104,7 +227,7 @@ def get_process_data(proclist, methodname):
     for x in proclist:
         try:
             item = getattr(x, methodname)()
-        except psutil.NoSuchProcess:
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
             item = None
         result.append(item)
     return result
@@ -172,22 +295,128 @@ def get_iorates(proclist, interval=0.2):
     iocnts_begin = get_iocounters(proclist)
     time.sleep(interval)
     iocnts_end = get_iocounters(proclist)
-    iorates = diff_iocounters(iocounters_begin, iocounters_end, interval)
+    iorates = diff_iocounters(iocnts_begin, iocnts_end, interval)
     return iorates
 
 
 def get_pcpus_iorates(proclist, interval=0.2):
-    cputimes_begin = get_cputimes(proclist)
-    iocnts_begin = get_iocounters(proclist)
-    time.sleep(interval)
-    cputimes_end = get_cputimes(proclist)
-    iocnts_end = get_iocounters(proclist)
-
-    pcpus = diff_cputimes(cputimes_begin, cputimes_end, interval)
-    iorates = diff_iocounters(iocnts_begin, iocnts_end, interval)
+    with spans.span('rates.read'):
+        cputimes_begin = get_cputimes(proclist)
+        iocnts_begin = get_iocounters(proclist)
+    with spans.span('rates.sleep'):
+        time.sleep(interval)
+    with spans.span('rates.read'):
+        cputimes_end = get_cputimes(proclist)
+        iocnts_end = get_iocounters(proclist)
+
+    with spans.span('rates.diff'):
+        pcpus = diff_cputimes(cputimes_begin, cputimes_end, interval)
+        iorates = diff_iocounters(iocnts_begin, iocnts_end, interval)
     return pcpus, iorates
 
 
+def get_process_key(proc):
+    """(pid, create time) identifies a process even when its pid is reused"""
+    try:
+        return (proc.pid, proc.create_time())
+    except psutil.NoSuchProcess:
+        return None
+
+
+class RateSampler:
+    """Computes cpu and IO rates against the readings of the previous call,
+    so that a call does not need to sleep.
+
+    Readings are keyed by "get_process_key". A process seen for the first
+    time (including a new process with a reused pid) gets NaN rates.
+    Readings of processes absent from the latest call are dropped.
+    """
+
+    def __init__(self):
+        # key -> (timestamp, cpu_times, io_counters)
+        self.last_readings = dict()
+
+    def has_readings(self, proclist):
+        return any(
+            (get_process_key(x) in self.last_readings) 
+            for x in proclist
+        )
+
+    def sample(self, proclist, pcpu=True, IO=True, prime_interval=None):
+        """Returns (pcpus, iorates) in the formats of "get_pcpus_iorates".
+        Disabled ones are None.
+
+        Args:
+            prime_interval: If given and there are no previous readings for 
+                "proclist", a first reading is taken and this many seconds 
+                are slept, so that the first call also returns rates.
+        """
+        if (prime_interval is not None) and (not self.has_readings(proclist)):
+            self.sample(proclist, pcpu=pcpu, IO=IO)
+            with spans.span('rates.sleep'):
+                time.sleep(prime_interval)
+
+        keys = [get_process_key(x) for x in proclist]
+        now = time.monotonic()
+        cputimes_end = (get_cputimes(proclist) if pcpu else [None] * len(proclist))
+        iocnts_end = (get_iocounters(proclist) if IO else [None] * len(proclist))
+
+        previous = [self.last_readings.get(key) for key in keys]
+        intervals = np.asarray(
+            [(np.nan if x is None else (now - x[0])) for x in previous],
+            dtype=float,
+        )
+        cputimes_begin = [(None if x is None else x[1]) for x in previous]
+        iocnts_begin = [(None if x is None else x[2]) for x in previous]
+
+        self.last_readings = dict(
+            (key, (now, cputimes, iocnts))
+            for key, cputimes, iocnts in zip(keys, cputimes_end, iocnts_end)
+            if key is not None
+        )
+
+        pcpus = (diff_cputimes(cputimes_begin, cputimes_end, intervals) if pcpu else None)
+        iorates = (diff_iocounters(iocnts_begin, iocnts_end, intervals) if IO else None)
+        return pcpus, iorates
+
+
+def get_byuser_pcpu(sampler, interval=0.2):
+    """Same return values as "utils.get_byuser_pcpu", but pcpu is the usage
+    since the previous call with the same sampler rather than the lifetime
+    average shown by "ps".
+    """
+    proclist = list(psutil.process_iter(attrs=PCPU_DF_ATTRS))
+    all_df = make_pcpu_df(proclist, sampler, interval=interval)
+    byuser_dfs = dict(
+        (key, subdf) for key, subdf in all_df.groupby('user')
+    )
+    return all_df, byuser_dfs
+
+
+PCPU_DF_ATTRS = ('username', 'cmdline', 'create_time')
+
+
+def make_pcpu_df(proclist, sampler, interval=0.2):
+    """Args:
+        proclist: processes with "info" containing PCPU_DF_ATTRS
+    """
+    pcpus, _ = sampler.sample(proclist, IO=False, prime_interval=interval)
+    return pd.DataFrame(
+        {
+            'pid': [x.pid for x in proclist],
+            'pcpu': (pcpus['user'] + pcpus['system'] + pcpus['iowait']),
+            'user': [x.info['username'] for x in proclist],
+            'cmd': [' '.join(x.info['cmdline'] or []) for x in proclist],
+            'create_time': get_create_time_column(proclist),
+        }
+    )
+
+
+def get_procs_pcpu(pids, sampler, interval=0.2):
+    """"make_pcpu_df" for "pids" only"""
+    return make_pcpu_df(get_processes(pids, PCPU_DF_ATTRS), sampler, interval=interval)
+
+
 def get_thread_states(thread_ids):
     result = list()
     for x in thread_ids:
@@ -200,6 +429,16 @@ def get_thread_states(thread_ids):
     return result
 
 
+def get_thread_state_counts(pids):
+    """Bulk replacement for calling "get_thread_states" on each process.
+    Returns a dict of int arrays aligned with "pids", with keys "R", "D", "S",
+    "Z" and "RD" (R + D).
+    """
+    counts = procfs.count_thread_states(pids, proc_root=psutil.PROCFS_PATH)
+    counts['RD'] = counts['R'] + counts['D']
+    return counts
+
+
 def into_procinfo_helper(proc, valgetter):
     try:
         val = valgetter(proc)
@@ -208,8 +447,13 @@ def into_procinfo_helper(proc, valgetter):
     return val
 
 
-def into_procinfo_noncpu(proc):
-    """Makes a source dictionary for ProcessInfo instance"""
+def into_procinfo_noncpu(proc, thread_states=True):
+    """Makes a source dictionary for ProcessInfo instance
+    Args:
+        thread_states: If False, "thread_states" and "num_RD" are not set. 
+            Useful when they are filled for all processes at once with
+            "get_thread_state_counts".
+    """
 
     assert isinstance(proc, psutil.Process)
     assert hasattr(proc, 'info')
@@ -235,15 +479,12 @@ def into_procinfo_noncpu(proc):
             (lambda x: x.info['memory_info'].rss),
         )
 
-    procinfo_dict['tids'] = into_procinfo_helper(
-        proc,
-        (lambda x: [x.id for x in proc.info['threads']]),
-    )
-    procinfo_dict['thread_states'] = get_thread_states(procinfo_dict['tids'])
-    procinfo_dict['num_RD'] = sum(
-        (x in RD_STATUSES)
-        for x in procinfo_dict['thread_states']
-    )
+    if thread_states:
+        counts = get_thread_state_counts([proc.pid])
+        procinfo_dict['thread_states'] = dict(
+            (key, int(val[0])) for key, val in counts.items()
+        )
+        procinfo_dict['num_RD'] = procinfo_dict['thread_states']['RD']
 
     return procinfo_dict
 
@@ -298,7 +539,6 @@ def run_process_iter(root=True):
     attrs = [
         'cmdline',
         'pid',
-        'threads',
         'username',
         ('memory_full_info' if root else 'memory_info'),
     ]
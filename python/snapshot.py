@@ -3,10 +3,15 @@ import pprint
 import argparse
 import socket
 
+import pandas as pd
+
 import utils
+import procsnapshot
+import spans
 
 
 MAX_PROCS_DF_KEYS = [
+    'hostname',
     'pid',
     'user',
     'pcpu_total',
@@ -15,8 +20,8 @@ MAX_PROCS_DF_KEYS = [
     'rss_GB',
     'pss_GB',
 
-    'read_MB_per_sec',
-    'written_MB_per_sec',
+    'read MB/s',
+    'write MB/s',
 
     'cmd',
 ]
@@ -32,8 +37,8 @@ GROUPED_DF_KEYS = [
     'rss_GB',
     'pss_GB',
 
-    'read_MB_per_sec',
-    'written_MB_per_sec',
+    'read MB/s',
+    'write MB/s',
 ]
 
 
@@ -65,6 +70,13 @@ def argument_parsing():
         type=float,
         dest='interval',
     )
+    parser.add_argument(
+        '--timeout', 
+        help=f'Time limit (in seconds) for each node. Nodes exceeding this are omitted.',
+        default=60,
+        type=float,
+        dest='timeout',
+    )
     parser.add_argument(
         '-n', '--num-maxproc', 
         help=f'The number of processes with maximal cpu/memory usage to print',
@@ -72,6 +84,18 @@ def argument_parsing():
         type=int,
         dest='num_maxproc',
     )
+    parser.add_argument(
+        '--ssh-report',
+        help=f'If set, per-node ssh handshake and execution times are printed.',
+        action='store_true',
+        dest='ssh_report',
+    )
+    parser.add_argument(
+        '--profile',
+        help=f'If set, time spent in each stage (ssh, remote imports, /proc reading, sleeping, merging) is printed for each node.',
+        action='store_true',
+        dest='profile',
+    )
     parser.add_argument(
         '--save',
         help=f'If set, snapshot result is saved as a tsv file to "./snapshot.tsv.gz"',
@@ -83,30 +107,58 @@ def argument_parsing():
     return args
 
 
-def main():
-    args = argument_parsing()
-
-    snapshot_df = utils.get_snapshot_df(nodes=args.nodes)
-    grouped_snapshot_df = snapshot_df.groupby(['hostname', 'user'])[GROUPED_DF_KEYS].sum()
-
-    snapshot = utils.get_byuser_snapshot(interval=args.interval, gross_cpu_percents=False)
-    maxcpu_df = utils.pick_maxcpu_procs(snapshot['proc_snapshot_df'], n=args.num_maxproc)
-    maxmem_df = utils.pick_maxmem_procs(snapshot['proc_snapshot_df'], n=args.num_maxproc)
+def make_aggspec(num_maxproc):
+    aggspec = dict(procsnapshot.DEFAULT_AGGSPEC)
+    aggspec['sum'] = GROUPED_DF_KEYS
+    aggspec['topn'] = num_maxproc
+    aggspec['topn_by'] = ['pcpu_total', 'pss_GB']
+    aggspec['topn_columns'] = MAX_PROCS_DF_KEYS
+    return aggspec
 
-    print(snapshot['grouped_df'])
-    print()
-    print(f'{args.num_maxproc} processes with largest pcpu:') 
-    print(maxcpu_df.loc[:, MAX_PROCS_DF_KEYS])
-    print()
-    print(f'{args.num_maxproc} processes with largest memory:') 
-    print(maxmem_df.loc[:, MAX_PROCS_DF_KEYS])
 
-    if args.save:
+def main():
+    args = argument_parsing()
+    if args.profile:
+        spans.enable()
+
+    # one collection feeds every printed table and the saved file
+    with spans.span('collect'):
+        report = procsnapshot.SnapshotReport.collect(
+            nodelist=args.nodes, 
+            aggspec=make_aggspec(args.num_maxproc), 
+            full=args.save,
+            interval=args.interval, 
+            timeout=args.timeout,
+        )
+
+    if report.grouped.shape[0] == 0:
+        print(f'No nodes responded.')
+    else:
+        print(report.grouped_with_sum)
+        print()
+        print(f'{args.num_maxproc} processes with largest pcpu:') 
+        print(report.maxcpu)
+        print()
+        print(f'{args.num_maxproc} processes with largest memory:') 
+        print(report.maxmem)
+
+    if args.save and (report.grouped.shape[0] > 0):
         savepath = './snapshot.tsv.gz'
         if not os.path.exists(savepath):
-            snapshot['proc_snapshot_df'].to_csv(savepath, sep='\t', header=True, index=False)
+            report.save(savepath)
         else:
             print(f'File {repr(savepath)} already exists. Snapshot dataframe is not written.')
+
+    if args.ssh_report:
+        print()
+        print(f'ssh handshake and execution times (seconds):')
+        print(utils.SSH_POOL.report())
+
+    if args.profile:
+        print()
+        print(f'Time spent in each stage (seconds):')
+        with pd.option_context('display.max_rows', None, 'display.width', None):
+            print(spans.make_report())
     
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+"""Stage timing instrumentation.
+
+Code is instrumented with "span" (a context manager) and "timed" (a
+decorator). Both are no-ops until "enable" is called: "span" then returns a
+shared do-nothing object and "timed" functions call straight through, so
+instrumented code pays only a global flag check.
+
+Each finished span is recorded as (hostname, name, seconds). Remote calls
+made while spans are enabled ask the agent to enable them too, and the
+remote records are returned in the response status (see sshagent.py), so
+a single report covers the coordinator and every node.
+
+Only the standard library is imported at module level, since the agent
+imports this module before the called function is timed.
+
+Usage:
+    spans.enable()
+    with spans.span('concat'):
+        ...
+    print(spans.make_report())
+"""
+
+import time
+import socket
+import importlib
+import functools
+import threading
+
+
+HOSTNAME = socket.gethostname()
+RECORD_COLUMNS = ['hostname', 'name', 'sec']
+REPORT_COLUMNS = ['total_sec', 'num_calls', 'max_sec']
+
+ENABLED = False
+RECORDS = list()
+RECORDS_LOCK = threading.Lock()
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def is_enabled():
+    return ENABLED
+
+
+class Span:
+    __slots__ = ('name', 'hostname', 't0')
+
+    def __init__(self, name, hostname=HOSTNAME):
+        self.name = name
+        self.hostname = hostname
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        RECORDS.append((self.hostname, self.name, time.perf_counter() - self.t0))
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, hostname=HOSTNAME):
+    """Args:
+        hostname: The node the span is attributed to. Spans of the
+            coordinator that concern a single node (e.g. its ssh session)
+            should give that node.
+    """
+    if not ENABLED:
+        return NULL_SPAN
+    return Span(name, hostname)
+
+
+def timed(name=None):
+    """Decorator recording each call of the function as a span named
+    "name" (default: the qualified name of the function).
+    """
+    def decorator(func):
+        span_name = (func.__qualname__ if name is None else name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with Span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_records(records, hostname=None):
+    """Adds records collected elsewhere, e.g. on a remote node
+
+    Args:
+        hostname: If given, replaces the hostname of each record. Remote
+            records carry the name the node gives itself, which may differ
+            from the name it was dialed by (e.g. a short name or alias in 
+            the nodelist).
+    """
+    if hostname is not None:
+        records = [(hostname, name, sec) for _, name, sec in records]
+    RECORDS.extend(records)
+
+
+def pop_records():
+    with RECORDS_LOCK:
+        records = list(RECORDS)
+        del RECORDS[:len(records)]
+    return records
+
+
+def make_report(records=None):
+    """Returns a DataFrame with columns REPORT_COLUMNS, indexed by
+    (hostname, name). Hosts and the spans of each host are in the order
+    they were first recorded.
+    """
+    pd = importlib.import_module('pandas')
+    if records is None:
+        records = list(RECORDS)
+    df = pd.DataFrame.from_records(records, columns=RECORD_COLUMNS)
+    hostnames = pd.unique(df['hostname'])
+    df['hostname'] = pd.Categorical(df['hostname'], categories=hostnames, ordered=True)
+    df.sort_values('hostname', kind='stable', inplace=True)
+
+    grouped = df.groupby(['hostname', 'name'], sort=False, observed=True)['sec']
+    report = pd.DataFrame(
+        {
+            'total_sec': grouped.sum(),
+            'num_calls': grouped.size(),
+            'max_sec': grouped.max(),
+        },
+        columns=REPORT_COLUMNS,
+    )
+    return report
@@ -0,0 +1,267 @@
+"""Long-lived function-call agent, run on a remote node over ssh.
+
+The agent reads pickled requests from stdin and writes pickled responses to
+stdout, one length-prefixed frame each. Imported modules stay loaded between
+calls, so only the first call pays for interpreter startup and imports.
+With --oneshot, a single request is served and the process exits; this is
+the pipe transport of utils.run_over_ssh.
+A "call" request with "profile" set is timed with spans.py, and the span
+records are returned in the response status under "spans".
+
+Usage: python sshagent.py [--oneshot] [--preload module1,module2,...]
+"""
+
+import sys
+import os
+import struct
+import pickle
+import zlib
+import importlib
+import traceback
+import argparse
+
+
+# (flags, payload length)
+FRAME_HEADER = struct.Struct('!BQ')
+FLAG_ZLIB = 1
+COMPRESS_LEVEL = 1
+DEFAULT_CHUNK_ROWS = 20000
+
+
+###########
+# framing #
+###########
+
+def read_exact(f, size):
+    chunks = list()
+    remaining = size
+    while remaining > 0:
+        chunk = f.read(remaining)
+        if not chunk:
+            raise EOFError(f'Stream closed with {remaining} bytes remaining')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def encode_frame(obj, compress=False):
+    """Returns (header, payload) bytes"""
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    flags = 0
+    if compress:
+        data = zlib.compress(data, COMPRESS_LEVEL)
+        flags |= FLAG_ZLIB
+    return FRAME_HEADER.pack(flags, len(data)), data
+
+
+def write_encoded(f, encoded):
+    header, data = encoded
+    f.write(header)
+    f.write(data)
+    f.flush()
+
+
+def write_frame(f, obj, compress=False):
+    write_encoded(f, encode_frame(obj, compress=compress))
+
+
+def read_frame(f):
+    flags, size = FRAME_HEADER.unpack(read_exact(f, FRAME_HEADER.size))
+    data = read_exact(f, size)
+    if flags & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    return pickle.loads(data)
+
+
+def is_dataframe(obj):
+    pd = sys.modules.get('pandas')
+    return (pd is not None) and isinstance(obj, pd.DataFrame)
+
+
+def iter_value_frames(value, compress=False, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Yields encoded frames, each pickled only when requested. 
+    DataFrames longer than "chunk_rows" are sent as a sequence of row
+    chunks, so the whole table is never pickled into a single buffer.
+    """
+    if (
+        (chunk_rows is not None)
+        and is_dataframe(value)
+        and (value.shape[0] > chunk_rows)
+    ):
+        starts = range(0, value.shape[0], chunk_rows)
+        yield encode_frame({'kind': 'chunked', 'nchunks': len(starts)}, compress=compress)
+        for start in starts:
+            yield encode_frame(value.iloc[start:(start + chunk_rows)], compress=compress)
+    else:
+        yield encode_frame({'kind': 'value', 'value': value}, compress=compress)
+
+
+def read_value(f):
+    header = read_frame(f)
+    if header['kind'] == 'value':
+        return header['value']
+    elif header['kind'] == 'chunked':
+        chunks = list()
+        for _ in range(header['nchunks']):
+            chunk = read_frame(f)
+            # a chunk that could not be pickled ends the value early
+            if isinstance(chunk, dict) and (chunk.get('kind') == 'error'):
+                raise Exception(f'Remote value could not be sent; traceback=\n{chunk["error"]}')
+            chunks.append(chunk)
+        pd = importlib.import_module('pandas')
+        return pd.concat(chunks, axis=0)
+    else:
+        raise Exception(f'Unknown value kind: {repr(header["kind"])}')
+
+
+#########
+# agent #
+#########
+
+def get_function(module_dir, module_name, funcname):
+    if module_dir not in sys.path:
+        sys.path.append(module_dir)
+    module = importlib.import_module(module_name)
+    return getattr(module, funcname)
+
+
+def handle_request(request):
+    """Returns (status, result). "result" is meaningful only if status['ok']."""
+    if request['op'] == 'ping':
+        return {'ok': True}, os.getpid()
+    elif request['op'] == 'call':
+        if request.get('profile', False):
+            return handle_profiled_call(request)
+        try:
+            func = get_function(
+                request['module_dir'],
+                request['module_name'],
+                request['funcname'],
+            )
+            result = func(*request['args'], **request['kwargs'])
+        except Exception:
+            return {'ok': False, 'error': traceback.format_exc()}, None
+        else:
+            return {'ok': True}, result
+    else:
+        return {'ok': False, 'error': f'Unknown op: {repr(request["op"])}'}, None
+
+
+def handle_profiled_call(request):
+    spans = importlib.import_module('spans')
+    spans.enable()
+    try:
+        with spans.span('agent.import'):
+            func = get_function(
+                request['module_dir'],
+                request['module_name'],
+                request['funcname'],
+            )
+        with spans.span('agent.call'):
+            result = func(*request['args'], **request['kwargs'])
+    except Exception:
+        status = {'ok': False, 'error': traceback.format_exc()}
+        result = None
+    else:
+        status = {'ok': True}
+    finally:
+        spans.disable()
+    status['spans'] = spans.pop_records()
+    return status, result
+
+
+def write_response(outfile, request, status, result):
+    """The first value frame is pickled before the status is written, so a
+    result that cannot be pickled is reported as a failed call and the
+    stream stays usable. If a later chunk fails, an error frame is sent in
+    its place and the value ends there.
+    """
+    compress = request.get('compress', False)
+    if status['ok']:
+        frames = iter_value_frames(
+            result, 
+            compress=compress,
+            chunk_rows=request.get('chunk_rows', DEFAULT_CHUNK_ROWS),
+        )
+        try:
+            first_frame = next(frames)
+        except Exception:
+            status = dict(status, ok=False, error=traceback.format_exc())
+
+    write_frame(outfile, status, compress=compress)
+    if status['ok']:
+        write_encoded(outfile, first_frame)
+        while True:
+            try:
+                encoded = next(frames)
+            except StopIteration:
+                break
+            except Exception:
+                write_frame(outfile, {'kind': 'error', 'error': traceback.format_exc()}, compress=compress)
+                break
+            write_encoded(outfile, encoded)
+
+
+def read_response(infile):
+    """Returns (status, result)"""
+    status = read_frame(infile)
+    if status['ok']:
+        result = read_value(infile)
+    else:
+        result = None
+    return status, result
+
+
+def serve(infile, outfile, oneshot=False):
+    while True:
+        try:
+            request = read_frame(infile)
+        except EOFError:
+            break
+
+        if request['op'] == 'exit':
+            break
+
+        status, result = handle_request(request)
+        write_response(outfile, request, status, result)
+
+        if oneshot:
+            break
+
+
+def argument_parsing():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--oneshot',
+        help=f'If set, exits after serving a single request.',
+        action='store_true',
+        dest='oneshot',
+    )
+    parser.add_argument(
+        '--preload',
+        help=f'Comma-separated names of modules imported at startup.',
+        default='',
+        type=(lambda x: [y for y in x.split(',') if y != '']),
+        dest='preload',
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = argument_parsing()
+
+    # Responses are written to the original stdout. Anything printed by called
+    # functions is redirected to stderr so that it cannot corrupt the frames.
+    outfile = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    for module_name in args.preload:
+        importlib.import_module(module_name)
+
+    serve(sys.stdin.buffer, outfile, oneshot=args.oneshot)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,11 +20,23 @@ import json
 import warnings
 import pwd
 import multiprocessing
+import threading
+import atexit
+import asyncio
+import functools
+import concurrent.futures
+import signal
+import select
+import errno
 
 import psutil
 import numpy as np
 import pandas as pd
 
+import sshagent
+import procfs
+import spans
+
 
 ALL_NODES = [f'bnode{x}' for x in range(17)]
 
@@ -99,11 +111,302 @@ def rootcheck_ask_force(prompt=None):
             sys.exit(1)
 
 
+###################
+# ssh connections #
+###################
+
+SSH_CONTROL_DIR = os.path.join(tempfile.gettempdir(), f'svadmin-ssh-{os.getuid()}')
+SSH_CONTROL_PERSIST = '30m'
+# seconds allowed for the TCP connection, and for the whole master startup
+SSH_CONNECT_TIMEOUT = 10
+SSH_HANDSHAKE_TIMEOUT = 20
+
+
+def kill_process_group(proc):
+    """Args:
+        proc: a Popen started with "start_new_session=True"
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class SSHPool:
+    """Keeps one multiplexed (ControlMaster) ssh connection per host.
+
+    Master connections are left running in the background for
+    "control_persist", so later calls, including those from later
+    invocations of a script, skip the TCP and authentication handshake.
+    ssh never prompts (BatchMode), so a host that would ask for a password
+    fails instead of blocking.
+    """
+
+    def __init__(
+        self, 
+        control_dir=SSH_CONTROL_DIR, 
+        control_persist=SSH_CONTROL_PERSIST,
+        connect_timeout=SSH_CONNECT_TIMEOUT,
+        handshake_timeout=SSH_HANDSHAKE_TIMEOUT,
+    ):
+        self.control_dir = control_dir
+        self.control_persist = control_persist
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.connected = set()
+        # guards "host_locks", "handshakes" and "timings"
+        self.lock = threading.Lock()
+        self.host_locks = dict()
+        # hostname -> Popen of a master startup in progress
+        self.handshakes = dict()
+        self.timings = dict()
+
+    def control_options(self):
+        return [
+            '-o', f'ControlPath={os.path.join(self.control_dir, "%C")}',
+            '-o', f'ControlPersist={self.control_persist}',
+            '-o', 'BatchMode=yes',
+            '-o', f'ConnectTimeout={self.connect_timeout}',
+        ]
+
+    def get_host_lock(self, hostname):
+        with self.lock:
+            if hostname not in self.host_locks:
+                self.host_locks[hostname] = threading.Lock()
+            return self.host_locks[hostname]
+
+    def get_timings(self, hostname):
+        """Must be called with "self.lock" held"""
+        if hostname not in self.timings:
+            self.timings[hostname] = {'handshake_sec': 0.0, 'exec_sec': 0.0, 'num_calls': 0}
+        return self.timings[hostname]
+
+    def check_master(self, hostname):
+        try:
+            p = subprocess.run(
+                ['ssh', '-O', 'check', *self.control_options(), hostname],
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                timeout=self.handshake_timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return False
+        return p.returncode == 0
+
+    def start_master(self, hostname):
+        """Raises an exception if the master is not running after
+        "handshake_timeout" seconds. The backgrounded master inherits no
+        pipe, so waiting for the startup process never waits for the master.
+        """
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        with tempfile.TemporaryFile() as stderr_file:
+            proc = subprocess.Popen(
+                ['ssh', '-M', '-N', '-f', *self.control_options(), hostname],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=stderr_file,
+                # its own process group, so that a ProxyCommand child is killed with it
+                start_new_session=True,
+            )
+            with self.lock:
+                self.handshakes[hostname] = proc
+            try:
+                returncode = proc.wait(timeout=self.handshake_timeout)
+            except subprocess.TimeoutExpired:
+                kill_process_group(proc)
+                proc.wait()
+                returncode = None
+            finally:
+                with self.lock:
+                    self.handshakes.pop(hostname, None)
+
+            if (returncode != 0) or (not self.check_master(hostname)):
+                stderr_file.seek(0)
+                detail = (
+                    f'no connection within {self.handshake_timeout} seconds'
+                    if returncode is None else
+                    stderr_file.read().decode(errors='replace').strip()
+                )
+                raise Exception(
+                    f'Failed to start an ssh master connection to {hostname}; '
+                    f'returncode={returncode}, stderr={detail}'
+                )
+
+    def abort_handshake(self, hostname):
+        """Kills a master startup to "hostname" in progress, if any. The
+        thread waiting on it raises from "connect".
+        """
+        with self.lock:
+            proc = self.handshakes.get(hostname)
+        if proc is not None:
+            kill_process_group(proc)
+
+    def connect(self, hostname):
+        """Starts a master connection unless one is already running. A host
+        whose master fails to start is not remembered as connected.
+        """
+        with self.get_host_lock(hostname):
+            if hostname in self.connected:
+                return
+            if not self.check_master(hostname):
+                t0 = time.perf_counter()
+                try:
+                    self.start_master(hostname)
+                finally:
+                    with self.lock:
+                        self.get_timings(hostname)['handshake_sec'] += time.perf_counter() - t0
+            self.connected.add(hostname)
+
+    def ssh_args(self, hostname, remoteargs):
+        self.connect(hostname)
+        return ['ssh', *self.control_options(), hostname, remoteargs]
+
+    def record_exec(self, hostname, seconds):
+        with self.lock:
+            timings = self.get_timings(hostname)
+            timings['exec_sec'] += seconds
+            timings['num_calls'] += 1
+
+    def report(self):
+        """Returns a DataFrame of per-host handshake and execution times"""
+        with self.lock:
+            df = pd.DataFrame.from_dict(self.timings, orient='index')
+        df.index.name = 'hostname'
+        return df
+
+    def close(self, hostname):
+        subprocess.run(
+            ['ssh', '-O', 'exit', *self.control_options(), hostname],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=self.handshake_timeout,
+        )
+        self.connected.discard(hostname)
+
+
+SSH_POOL = SSHPool()
+
+
 ################
 # run over ssh #
 ################
 
-def run_over_ssh(hostname, func, args=tuple(), kwargs=dict()):
+def run_over_ssh(
+    hostname, func, args=tuple(), kwargs=dict(), transport='pipe', compress=False,
+):
+    """Args:
+        transport: 
+            "pipe": arguments and result are streamed through stdin/stdout
+                of the ssh session. No file is created.
+            "file": arguments and result are exchanged through pickle files
+                in the current directory, which must be on a shared filesystem.
+        compress: (Bool) Whether payloads are zlib-compressed. Only for "pipe".
+    """
+    if transport == 'pipe':
+        return run_over_ssh_pipe(hostname, func, args=args, kwargs=kwargs, compress=compress)
+    elif transport == 'file':
+        return run_over_ssh_file(hostname, func, args=args, kwargs=kwargs)
+    else:
+        raise Exception(f'"transport" must be either pipe or file')
+
+
+def get_sshagent_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sshagent.py')
+
+
+def make_call_request(func, args, kwargs, compress=False):
+    """Remote spans are enabled whenever spans are enabled here"""
+    module_dir, module_name, funcname = get_func_location(func)
+    request = {
+        'op': 'call',
+        'module_dir': module_dir,
+        'module_name': module_name,
+        'funcname': funcname,
+        'args': args,
+        'kwargs': kwargs,
+        'compress': compress,
+    }
+    if spans.ENABLED:
+        request['profile'] = True
+    return request
+
+
+def make_oneshot_request(func, args, kwargs, compress=False):
+    """Returns (remote command, bytes to be written to its stdin)"""
+    request_buf = io.BytesIO()
+    sshagent.write_frame(
+        request_buf, 
+        make_call_request(func, args, kwargs, compress=compress),
+        compress=compress,
+    )
+    remoteargs = shlex.join([sys.executable, get_sshagent_path(), '--oneshot'])
+    return remoteargs, request_buf.getvalue()
+
+
+def run_over_ssh_pipe(hostname, func, args=tuple(), kwargs=dict(), compress=False):
+    """The response is unpickled frame by frame as it arrives on the stdout
+    of ssh, so a chunked result is never buffered whole as bytes.
+    """
+    with spans.span('ssh.pickle', hostname):
+        remoteargs, request_bytes = make_oneshot_request(func, args, kwargs, compress=compress)
+    try:
+        with spans.span('ssh.connect', hostname):
+            ssh_args = SSH_POOL.ssh_args(hostname, remoteargs)
+    except Exception as exc:
+        this_func_name = inspect.stack()[0].function
+        print(f'"{this_func_name}" failed; hostname={hostname}, function={func}, error={exc}')
+        return None
+
+    status = None
+    error = None
+    t0 = time.perf_counter()
+    # stderr goes to a file, so that it cannot fill a pipe while stdout is read
+    with tempfile.TemporaryFile() as stderr_file:
+        with spans.span('ssh.exec', hostname):
+            p = subprocess.Popen(
+                ssh_args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=stderr_file,
+            )
+            try:
+                p.stdin.write(request_bytes)
+                p.stdin.close()
+                status, result = sshagent.read_response(p.stdout)
+            except Exception as exc:
+                # EOF, a broken pipe, or a response that cannot be unpickled
+                error = exc
+                p.kill()
+            finally:
+                p.stdout.close()
+                p.wait()
+        SSH_POOL.record_exec(hostname, time.perf_counter() - t0)
+
+        if status is not None:
+            spans.add_records(status.get('spans', ()), hostname=hostname)
+        if (status is None) or (not status['ok']):
+            this_func_name = inspect.stack()[0].function
+            if status is None:
+                stderr_file.seek(0)
+                detail = f'{error!r}; ' + stderr_file.read().decode(errors='replace')
+            else:
+                detail = status['error']
+            msg = f'"{this_func_name}" failed; hostname={hostname}, function={func}, stderr={detail}'
+            print(msg)
+            result = None
+
+    return result
+
+
+def run_over_ssh_file(hostname, func, args=tuple(), kwargs=dict()):
+    try:
+        with spans.span('ssh.connect', hostname):
+            SSH_POOL.connect(hostname)
+    except Exception as exc:
+        this_func_name = inspect.stack()[0].function
+        print(f'"{this_func_name}" failed; hostname={hostname}, function={func}, error={exc}')
+        return None
+
     # pickle args and kwargs
     uniqid = uuid.uuid4()
     args_pklpath = make_tmpfile_path(
@@ -121,13 +424,7 @@ def run_over_ssh(hostname, func, args=tuple(), kwargs=dict()):
         pickle.dump(kwargs, f)
 
     # make parameters
-    module = inspect.getmodule(func)
-    assert hasattr(module, '__file__')
-    module_path = os.path.abspath(module.__file__)
-    module_dir = os.path.dirname(module_path)
-    module_name = re.sub(r'\.py$', '', os.path.basename(module_path))
-
-    funcname = func.__name__
+    module_dir, module_name, funcname = get_func_location(func)
 
     python = sys.executable
     remotearg_pycmd = textwrap.dedent(
@@ -151,17 +448,22 @@ def run_over_ssh(hostname, func, args=tuple(), kwargs=dict()):
     )
         # tmpfile paths for pickle are removed here
     remoteargs = shlex.join([python, '-c', remotearg_pycmd])
+    ssh_args = SSH_POOL.ssh_args(hostname, remoteargs)
     
-    p = subprocess.run(
-        ['ssh', hostname, remoteargs],
-        capture_output=True,
-        text=True,
-        check=False,
-    )
+    t0 = time.perf_counter()
+    with spans.span('ssh.exec', hostname):
+        p = subprocess.run(
+            ssh_args,
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+    SSH_POOL.record_exec(hostname, time.perf_counter() - t0)
 
     if p.returncode == 0:
-        with open(result_pklpath, 'rb') as f:
-            result = pickle.load(f)
+        with spans.span('ssh.unpickle', hostname):
+            with open(result_pklpath, 'rb') as f:
+                result = pickle.load(f)
     else:
         this_func_name = inspect.stack()[0].function
         msg = f'"{this_func_name}" failed; hostname={hostname}, function={func}, stderr={p.stderr}'
@@ -176,6 +478,277 @@ def run_over_ssh(hostname, func, args=tuple(), kwargs=dict()):
     return result
 
 
+def get_func_location(func):
+    module = inspect.getmodule(func)
+    assert hasattr(module, '__file__')
+    module_path = os.path.abspath(module.__file__)
+    module_dir = os.path.dirname(module_path)
+    module_name = re.sub(r'\.py$', '', os.path.basename(module_path))
+    return module_dir, module_name, func.__name__
+
+
+##############
+# ssh agents #
+##############
+
+AGENT_PRELOAD_MODULES = ['numpy', 'pandas', 'psutil']
+
+
+class SSHAgent:
+    """A persistent python process on a remote node, started once over ssh.
+
+    Function calls are sent over the stdin/stdout of a single ssh session
+    (see sshagent.py), so imports and connection setup are paid only once.
+    """
+
+    def __init__(
+        self, hostname, python=sys.executable, preload=AGENT_PRELOAD_MODULES, compress=False,
+    ):
+        self.hostname = hostname
+        self.python = python
+        self.compress = compress
+        self.preload = list(preload)
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        remoteargs = shlex.join(
+            [self.python, get_sshagent_path(), '--preload', ','.join(self.preload)]
+        )
+        self.proc = subprocess.Popen(
+            SSH_POOL.ssh_args(self.hostname, remoteargs),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def is_alive(self):
+        return (self.proc is not None) and (self.proc.poll() is None)
+
+    def request(self, request):
+        """Returns (status, result)"""
+        with self.lock:
+            if not self.is_alive():
+                with spans.span('agent.start', self.hostname):
+                    self.start()
+            try:
+                sshagent.write_frame(
+                    self.proc.stdin, request, compress=request.get('compress', False),
+                )
+                response = sshagent.read_response(self.proc.stdout)
+            except (EOFError, OSError):
+                self.close()
+                raise
+        return response
+
+    def call(self, func, args=tuple(), kwargs=dict()):
+        t0 = time.perf_counter()
+        with spans.span('agent.request', self.hostname):
+            status, result = self.request(
+                make_call_request(func, args, kwargs, compress=self.compress)
+            )
+        SSH_POOL.record_exec(self.hostname, time.perf_counter() - t0)
+        spans.add_records(status.get('spans', ()), hostname=self.hostname)
+        if not status['ok']:
+            raise Exception(
+                f'Remote call failed; hostname={self.hostname}, function={func}, '
+                f'traceback=\n{status["error"]}'
+            )
+        return result
+
+    def close(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            try:
+                sshagent.write_frame(self.proc.stdin, {'op': 'exit'})
+                self.proc.stdin.close()
+                self.proc.wait(timeout=3)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+                self.proc.wait()
+        self.proc = None
+
+    def kill(self):
+        """Kills the agent without waiting for a pending request"""
+        proc = self.proc
+        if (proc is not None) and (proc.poll() is None):
+            proc.kill()
+
+
+AGENTS = dict()
+AGENTS_LOCK = threading.Lock()
+
+
+def get_agent(hostname):
+    with AGENTS_LOCK:
+        if hostname not in AGENTS:
+            AGENTS[hostname] = SSHAgent(hostname)
+        return AGENTS[hostname]
+
+
+def close_agents():
+    with AGENTS_LOCK:
+        for agent in AGENTS.values():
+            agent.close()
+        AGENTS.clear()
+
+
+atexit.register(close_agents)
+
+
+def run_over_agent(hostname, func, args=tuple(), kwargs=dict()):
+    """Same interface as "run_over_ssh", but reuses a persistent agent"""
+    try:
+        result = get_agent(hostname).call(func, args=args, kwargs=kwargs)
+    except Exception as exc:
+        this_func_name = inspect.stack()[0].function
+        msg = f'"{this_func_name}" failed; hostname={hostname}, function={func}, error={exc}'
+        print(msg)
+        result = None
+
+    return result
+
+
+#################
+# node fan-out #
+#################
+
+NodeResult = collections.namedtuple(
+    'NodeResult', ['hostname', 'result', 'status', 'elapsed'],
+)
+
+
+async def run_over_ssh_async(hostname, func, args=tuple(), kwargs=dict(), compress=False):
+    """asyncio version of "run_over_ssh_pipe". Raises an exception on failure."""
+    loop = asyncio.get_running_loop()
+    with spans.span('ssh.pickle', hostname):
+        remoteargs, request_bytes = make_oneshot_request(func, args, kwargs, compress=compress)
+    # handshake of a new master connection is blocking
+    with spans.span('ssh.connect', hostname):
+        ssh_args = await loop.run_in_executor(None, SSH_POOL.ssh_args, hostname, remoteargs)
+
+    t0 = time.perf_counter()
+    with spans.span('ssh.exec', hostname):
+        proc = await asyncio.create_subprocess_exec(
+            *ssh_args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await proc.communicate(request_bytes)
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+    SSH_POOL.record_exec(hostname, time.perf_counter() - t0)
+
+    if proc.returncode != 0:
+        raise Exception(f'ssh exited with {proc.returncode}; stderr={stderr.decode(errors="replace")}')
+    with spans.span('ssh.unpickle', hostname):
+        status, result = sshagent.read_response(io.BytesIO(stdout))
+    spans.add_records(status.get('spans', ()), hostname=hostname)
+    if not status['ok']:
+        raise Exception(f'Remote call failed; traceback=\n{status["error"]}')
+
+    return result
+
+
+async def run_over_agent_async(hostname, func, args=tuple(), kwargs=dict()):
+    agent = get_agent(hostname)
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(
+            None, functools.partial(agent.call, func, args=args, kwargs=kwargs),
+        )
+    except asyncio.CancelledError:
+        # unblocks the worker thread reading from the agent
+        agent.kill()
+        raise
+
+
+async def run_node_async(hostname, func, args=tuple(), kwargs=dict(), use_agent=True, timeout=None):
+    """Never raises. Failed or late nodes get a result of None."""
+    t0 = time.perf_counter()
+    if use_agent:
+        coro = run_over_agent_async(hostname, func, args=args, kwargs=kwargs)
+    else:
+        coro = run_over_ssh_async(hostname, func, args=args, kwargs=kwargs)
+
+    try:
+        result = await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        print(f'{hostname}: no result within {timeout} seconds; function={func}')
+        # a worker thread may still be blocked in the master startup
+        SSH_POOL.abort_handshake(hostname)
+        result = None
+        status = 'timeout'
+    except Exception as exc:
+        print(f'{hostname}: remote call failed; function={func}, error={exc}')
+        result = None
+        status = 'failed'
+    else:
+        status = 'ok'
+
+    elapsed = time.perf_counter() - t0
+    if spans.ENABLED:
+        spans.add_records([(hostname, 'node.total', elapsed)])
+    return NodeResult(hostname, result, status, elapsed)
+
+
+def iter_over_nodes(nodelist, func, args=tuple(), kwargs=dict(), use_agent=True, timeout=None):
+    """Runs "func" on all nodes concurrently in a single event loop and
+    yields NodeResult objects in the order they finish.
+
+    Args:
+        timeout: Deadline in seconds for each node. A node that misses it is
+            yielded with status "timeout" and a result of None.
+    """
+    nodelist = list(nodelist)
+    loop = asyncio.new_event_loop()
+    # worker threads only wait on agents or on ssh master startup
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(nodelist), 1))
+    loop.set_default_executor(executor)
+    pending = set(
+        loop.create_task(
+            run_node_async(
+                host, func, args=args, kwargs=kwargs, use_agent=use_agent, timeout=timeout,
+            )
+        )
+        for host in nodelist
+    )
+    try:
+        while pending:
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+        # Threads of late nodes are not joined. They end once their
+        # handshake is aborted or times out, or their agent is killed.
+        executor.shutdown(wait=False, cancel_futures=True)
+        loop.close()
+
+
+def run_over_nodes(nodelist, func, args=tuple(), kwargs=dict(), use_agent=True, timeout=None):
+    """Runs "func" on each node and returns the results in the order of "nodelist".
+    Results of failed or late nodes are None.
+    """
+    node_results = dict(
+        (x.hostname, x.result)
+        for x in iter_over_nodes(
+            nodelist, func, args=args, kwargs=kwargs, use_agent=use_agent, timeout=timeout,
+        )
+    )
+    return [node_results[host] for host in nodelist]
+
+
 ############
 # logutils #
 ############
@@ -208,28 +781,191 @@ def print_timestamp(*args, **kwargs):
 # kill #
 ########
 
-def kill_proc(pidlist, timeout=3, raise_on_absent=False):
-    proclist = [psutil.Process(x) for x in pidlist]
-    for proc in proclist:
+KILL_RESULT_COLUMNS = ['pid', 'status', 'exit_sec']
+# status values:
+#   exited: exited after SIGTERM
+#   killed: exited after SIGKILL
+#   absent: already gone when kill started
+#   denied: no permission to signal
+#   alive: still alive after SIGKILL and "kill_timeout"
+
+
+# create times within this many seconds are taken as the same process
+CREATE_TIME_TOLERANCE = 0.01
+
+
+def kill_procs(pidlist, timeout=3, kill_timeout=3, create_times=None):
+    """Sends SIGTERM to all processes at once and waits for all of them 
+    concurrently. A process still alive "timeout" seconds after SIGTERM gets 
+    SIGKILL. Returns as soon as the last process exits.
+
+    Args:
+        create_times: psutil create times aligned with "pidlist", taken 
+            when the pids were collected. A process whose create time 
+            differs is a new process reusing the pid; it is not signalled 
+            and is reported as "absent". None or NaN skips the check.
+
+    Returns:
+        DataFrame with columns KILL_RESULT_COLUMNS. "exit_sec" is the time 
+        from SIGTERM to exit, NaN if the process did not exit.
+    """
+    if create_times is None:
+        create_times = [None] * len(pidlist)
+    if hasattr(os, 'pidfd_open'):
         try:
-            proc.terminate()
-        except psutil.NoSuchProcess:
-            if raise_on_absent:
+            return kill_procs_pidfd(
+                pidlist, timeout=timeout, kill_timeout=kill_timeout, create_times=create_times,
+            )
+        except OSError as exc:
+            # e.g. ENOSYS on kernels older than 5.3
+            if exc.errno != errno.ENOSYS:
                 raise
-            else:
-                pass
+    return kill_procs_psutil(
+        pidlist, timeout=timeout, kill_timeout=kill_timeout, create_times=create_times,
+    )
+
+
+def get_create_times(procs_df):
+    """"create_times" argument of "kill_procs" for the rows of "procs_df", 
+    or None if it has no "create_time" column.
+    """
+    if 'create_time' not in procs_df.columns:
+        return None
+    return procs_df['create_time'].tolist()
+
 
-    gone, alive = psutil.wait_procs(proclist, timeout=timeout, callback=None)
-    if len(alive) > 0:
-        for proc in alive:
+def is_same_create_time(create_time, expected):
+    if (expected is None) or np.isnan(expected):
+        return True
+    return abs(create_time - expected) < CREATE_TIME_TOLERANCE
+
+
+def kill_procs_pidfd(pidlist, timeout=3, kill_timeout=3, create_times=None):
+    """pidfds become readable when the process exits. A pidfd refers to one
+    process, so signals sent through it cannot reach a process that reuses
+    the pid after "pidfd_open". A pid reused earlier (after the pids were 
+    collected) is detected with "create_times" once the pidfd is open.
+    """
+    if create_times is None:
+        create_times = [None] * len(pidlist)
+    results = dict((pid, {'pid': pid, 'status': 'absent', 'exit_sec': np.nan}) for pid in pidlist)
+    epoll = select.epoll()
+    fds = dict()  # fd -> pid
+    deadlines = dict()  # fd -> (deadline, next signal)
+    try:
+        t0 = time.monotonic()
+        for pid, expected_create_time in zip(pidlist, create_times):
+            try:
+                fd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                continue
+            # The pidfd pins whichever process has the pid now. If that is
+            # not the collected one, or it is already gone, it is skipped.
             try:
-                proc.kill()
+                same = is_same_create_time(psutil.Process(pid).create_time(), expected_create_time)
             except psutil.NoSuchProcess:
-                if raise_on_absent:
-                    raise
-                else:
+                same = False
+            if not same:
+                os.close(fd)
+                continue
+            try:
+                signal.pidfd_send_signal(fd, signal.SIGTERM)
+            except ProcessLookupError:
+                # exited between pidfd_open and the signal
+                os.close(fd)
+                continue
+            except PermissionError:
+                os.close(fd)
+                results[pid]['status'] = 'denied'
+                continue
+            fds[fd] = pid
+            deadlines[fd] = (time.monotonic() + timeout, signal.SIGKILL)
+            results[pid]['status'] = 'alive'
+            epoll.register(fd, select.EPOLLIN)
+
+        while fds:
+            wait_sec = max(min(x[0] for x in deadlines.values()) - time.monotonic(), 0)
+            for fd, _ in epoll.poll(wait_sec):
+                pid = fds.pop(fd)
+                sig = deadlines.pop(fd)[1]
+                results[pid]['status'] = ('exited' if sig == signal.SIGKILL else 'killed')
+                results[pid]['exit_sec'] = time.monotonic() - t0
+                epoll.unregister(fd)
+                os.close(fd)
+
+            now = time.monotonic()
+            for fd, (deadline, sig) in list(deadlines.items()):
+                if now < deadline:
+                    continue
+                if sig is None:
+                    # gave up after SIGKILL
+                    del fds[fd]
+                    del deadlines[fd]
+                    epoll.unregister(fd)
+                    os.close(fd)
+                    continue
+                try:
+                    signal.pidfd_send_signal(fd, sig)
+                except ProcessLookupError:
                     pass
-        time.sleep(1)
+                deadlines[fd] = (now + kill_timeout, None)
+    finally:
+        for fd in fds:
+            os.close(fd)
+        epoll.close()
+
+    return pd.DataFrame.from_records(list(results.values()), columns=KILL_RESULT_COLUMNS)
+
+
+def kill_procs_psutil(pidlist, timeout=3, kill_timeout=3, create_times=None):
+    """Process objects guard later signals against pid reuse, so the create
+    time only needs to be compared once.
+    """
+    if create_times is None:
+        create_times = [None] * len(pidlist)
+    results = dict((pid, {'pid': pid, 'status': 'absent', 'exit_sec': np.nan}) for pid in pidlist)
+    t0 = time.monotonic()
+
+    def make_callback(status):
+        def callback(proc):
+            results[proc.pid]['status'] = status
+            results[proc.pid]['exit_sec'] = time.monotonic() - t0
+        return callback
+
+    proclist = list()
+    for pid, expected_create_time in zip(pidlist, create_times):
+        try:
+            proc = psutil.Process(pid)
+            if not is_same_create_time(proc.create_time(), expected_create_time):
+                continue
+            proc.terminate()
+        except psutil.NoSuchProcess:
+            continue
+        except psutil.AccessDenied:
+            results[pid]['status'] = 'denied'
+            continue
+        results[pid]['status'] = 'alive'
+        proclist.append(proc)
+
+    gone, alive = psutil.wait_procs(proclist, timeout=timeout, callback=make_callback('exited'))
+    for proc in alive:
+        try:
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(alive, timeout=kill_timeout, callback=make_callback('killed'))
+
+    return pd.DataFrame.from_records(list(results.values()), columns=KILL_RESULT_COLUMNS)
+
+
+def kill_proc(pidlist, timeout=3, raise_on_absent=False, create_times=None):
+    """Wrapper of "kill_procs" which returns its result"""
+    results = kill_procs(pidlist, timeout=timeout, create_times=create_times)
+    if raise_on_absent:
+        absent = results.loc[results['status'] == 'absent', 'pid']
+        if absent.shape[0] > 0:
+            raise psutil.NoSuchProcess(int(absent.iat[0]))
+    return results
 
 
 ######
@@ -352,170 +1088,76 @@ def df_sanitycheck(df):
     assert df.loc[df['pid'].notna(), ['state', 'tid']].isna().all(axis=None)
 
 
-def subdf_sanitycheck(subdf):
-    assert pd.notna(subdf['pid'].iloc[0])
-    assert subdf['pid'].iloc[1:].isna().all(), str(subdf)
-    assert len(subdf['user'].unique()) == 1
-
-
-def merge_subdf(subdf):
-    result = dict()
-
-    result['num_R'] = (subdf['state'] == 'R').sum()
-    result['num_D'] = (subdf['state'] == 'D').sum()
-    result['num_S'] = (subdf['state'] == 'S').sum()
-
-    second_to_end = subdf.iloc[1:, :]
-    result['pcpu_sum'] = second_to_end['pcpu'].sum()
-    result['num_threads'] = second_to_end.shape[0]
-
-    firstrow = subdf.iloc[0, :]
-    result['pid'] = firstrow['pid']
-    result['user'] = firstrow['user']
-    result['rss_kb'] = firstrow['rss']
-    result['cmd'] = firstrow['cmd']
-
-    return result
-
-
-def postprocess_df(df):
-    df_sanitycheck(df)
-
-    # make grouper
-    pids = list()
-    na_lengths = list()
-    for is_na, subiter in itertools.groupby(
-        zip(df['pid'].isna(), df['pid']),
-        key=(lambda x: x[0]),
-    ):
-        subiter_tup = tuple(subiter)
-        if is_na:
-            na_lengths.append(len(subiter_tup))
-        else:
-            assert len(subiter_tup) == 1
-            pids.append(subiter_tup[0][1])
-    grouper = np.repeat(pids, np.asarray(na_lengths) + 1)
-
-    # do groupby on df
-    tgroups = list()
-    tmerge_df_data = list()
-    for key, subdf in df.groupby(grouper):
-        subdf_sanitycheck(subdf)
-        # tgroups
+def get_tgroup_ids(df):
+    """Returns (group ids, is_leader). Each row belongs to the nearest
+    process (non-NA pid) row at or above it.
+    """
+    is_leader = df['pid'].notna().to_numpy()
+    if df.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64), is_leader
+    assert is_leader[0]
+    group_ids = np.cumsum(is_leader) - 1
+    return group_ids, is_leader
+
+
+def iter_tgroups(df, is_leader):
+    bounds = np.append(np.flatnonzero(is_leader), df.shape[0])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        subdf = df.iloc[start:end, :]
         groupspec = dict()
-        groupspec['pid'] = key
+        groupspec['pid'] = subdf['pid'].iloc[0]
         groupspec['all_lines'] = subdf
         groupspec['leader'] = subdf.iloc[0, :]  # a Series
         groupspec['threads'] = subdf.iloc[1:, :]  # a DataFrame
-        tgroups.append(groupspec)
-        # tmerge_df_data
-        tmerge_df_data.append(merge_subdf(subdf))
-    tmerge_df = pd.DataFrame.from_records(tmerge_df_data)
-
-    return tgroups, tmerge_df
-
-
-DEFAULT_PS_FORMAT = [
-    ('pid', None, 'pid'),
-    ('tid', None, 'tid'),
-    ('state', None, 'state'),
-    ('user', 50, 'user'),
-    ('pcpu', None, 'pcpu'),
-    ('rss', None, 'rss'),
-    ('cmd', None, 'cmd'),
-]
-
+        yield groupspec
 
-def make_ps_args(
-    format_names=None,
-    include_threads=False,
-):
-    assert len(format_names) > 0
-
-    if format_names is None:
-        format_names = ('pid', 'tid', 'state', 'user', 'pcpu', 'rss', 'cmd')
-
-    ps_format = list()
-    for x in format_names:
-        if x == 'user':
-            ps_format.append((x, 50, x))
-        else:
-            ps_format.append((x, None, x))
-
-    result = [
-        'ps', 
-        ('-mA' if include_threads else '-A'),
-    ]
-    for x in ps_format:
-        arg = x[0]
-        if x[1] is not None:
-            arg += f':{x[1]}'
-        if x[2] is not None:
-            arg += f'={x[2]}'
-        result.extend(('-o', arg))
-
-    return result
-
-
-def run_ps_read_with_pandas(
-    format_names=None,
-    include_threads=False,
-    int_keys=['pid', 'tid', 'rss'],
-    float_keys=['pcpu'],
-):
-    ps_args = make_ps_args(
-        format_names=format_names,
-        include_threads=include_threads,
-    )
-    p = subprocess.run(ps_args, text=True, capture_output=True)
-    header = p.stdout.split('\n')[0].split()
 
-    # prepare pandas parameters
-    if 'cmd' in header:
-        assert header.index('cmd') == len(header) - 1
-    dtype = collections.defaultdict(pd.StringDtype)
-    for key in int_keys:
-        if key in header:
-            dtype[key] = pd.Int64Dtype()
-    for key in float_keys:
-        if key in header:
-            dtype[key] = pd.Float64Dtype()
+def postprocess_df(df, with_tgroups=False):
+    """Merges each process row of "ps -m" style output with its thread rows.
 
-    def bad_line_handler(bad_line):
-        """For handling cmd strings"""
-        assert len(bad_line) > len(header)
-        new_line = list()
-        new_line.extend(bad_line[:(len(header) - 1)])
-        new_line.append(' '.join(bad_line[(len(header) - 1):]))
-        return new_line
-            
-    # run ps and read with pandas
-    #p = subprocess.Popen(ps_args, text=True, stdout=subprocess.PIPE)
-    df = pd.read_csv(
-        #p.stdout, 
-        io.StringIO(p.stdout),
-        sep=r'\s+', 
-        header=0,
-        names=header,
-        dtype=dtype,
-        na_values='-',
-        engine='python',
-        on_bad_lines=bad_line_handler,
+    Returns:
+        tgroups: None, or a list of per-process details if "with_tgroups" is True
+        tmerge_df: one row for each process
+    """
+    df_sanitycheck(df)
+    group_ids, is_leader = get_tgroup_ids(df)
+    num_groups = is_leader.sum()
+    leaders = df.loc[is_leader, :]
+
+    users = df['user'].to_numpy(dtype=object, na_value='')
+    assert (users == users[is_leader][group_ids]).all()
+
+    states = df['state'].to_numpy(dtype=object, na_value='')
+    thread_group_ids = group_ids[~is_leader]
+    thread_pcpus = df['pcpu'].to_numpy(dtype=float, na_value=np.nan)[~is_leader]
+
+    def count_per_group(mask):
+        return np.bincount(group_ids[mask], minlength=num_groups)
+
+    tmerge_df = pd.DataFrame(
+        {
+            'num_R': count_per_group(states == 'R'),
+            'num_D': count_per_group(states == 'D'),
+            'num_S': count_per_group(states == 'S'),
+            'pcpu_sum': np.bincount(
+                thread_group_ids, 
+                weights=np.nan_to_num(thread_pcpus), 
+                minlength=num_groups,
+            ),
+            'num_threads': np.bincount(thread_group_ids, minlength=num_groups),
+            'pid': leaders['pid'].to_numpy(dtype=np.int64),
+            'user': leaders['user'].array,
+            'rss_kb': leaders['rss'].array,
+            'cmd': leaders['cmd'].array,
+        }
     )
-    #p.wait()
-
-    return df
 
+    if with_tgroups:
+        tgroups = list(iter_tgroups(df, is_leader))
+    else:
+        tgroups = None
 
-def get_byuser_pcpu():
-    all_df = run_ps_read_with_pandas(
-        format_names=('pid', 'pcpu', 'user', 'cmd'),
-        include_threads=False,
-    )
-    byuser_dfs = dict(
-        (key, subdf) for key, subdf in all_df.groupby('user')
-    )
-    return all_df, byuser_dfs
+    return tgroups, tmerge_df
 
 
 def run_ps_new(
@@ -532,7 +1174,7 @@ def run_ps_new(
     float_keys=['pcpu'],
 ):
     df = run_ps_read_with_pandas(ps_format, int_keys, float_keys)
-    tgroups, tmerge_df = postprocess_df(df)
+    tgroups, tmerge_df = postprocess_df(df, with_tgroups=True)
 
     return tgroups, tmerge_df
 
@@ -558,11 +1200,11 @@ def make_ps_args(
     format_names=None,
     include_threads=False,
 ):
-    assert len(format_names) > 0
-
     if format_names is None:
         format_names = ('pid', 'tid', 'state', 'user', 'pcpu', 'rss', 'cmd')
 
+    assert len(format_names) > 0
+
     ps_format = list()
     for x in format_names:
         if x == 'user':
@@ -634,10 +1276,32 @@ def run_ps_read_with_pandas(
     return df
 
 
-def get_byuser_pcpu():
-    all_df = run_ps_read_with_pandas(
+def read_process_table(format_names=None, include_threads=False, method='procfs', proc_root=procfs.PROC_ROOT):
+    """Args:
+        method:
+            "procfs": read directly from "proc_root" (see procfs.read_proc_df)
+            "ps": run "ps" and parse its output with pandas
+    """
+    if method == 'procfs':
+        return procfs.read_proc_df(
+            format_names=format_names, include_threads=include_threads, proc_root=proc_root,
+        )
+    elif method == 'ps':
+        if proc_root != procfs.PROC_ROOT:
+            raise Exception(f'"proc_root" cannot be used with method "ps"')
+        return run_ps_read_with_pandas(
+            format_names=format_names, include_threads=include_threads,
+        )
+    else:
+        raise Exception(f'"method" must be either procfs or ps')
+
+
+def get_byuser_pcpu(method='procfs', proc_root=procfs.PROC_ROOT):
+    all_df = read_process_table(
         format_names=('pid', 'pcpu', 'user', 'cmd'),
         include_threads=False,
+        method=method,
+        proc_root=proc_root,
     )
     byuser_dfs = dict(
         (key, subdf) for key, subdf in all_df.groupby('user')
@@ -645,10 +1309,20 @@ def get_byuser_pcpu():
     return all_df, byuser_dfs
 
 
-def get_load_snapshot():
-    all_df = run_ps_read_with_pandas(
+def get_load_snapshot(method='procstat', proc_root=procfs.PROC_ROOT):
+    """Returns the number of threads in R or D state.
+    Args:
+        method: "procstat" reads the counters in /proc/stat. Other values 
+            are passed to "read_process_table", which counts every thread.
+    """
+    if method == 'procstat':
+        return sum(procfs.read_run_queue(proc_root))
+
+    all_df = read_process_table(
         format_names=('state',),
         include_threads=True,
+        method=method,
+        proc_root=proc_root,
     )
     return all_df['state'].isin(['R', 'D']).sum()
 
@@ -656,14 +1330,67 @@ def get_load_snapshot():
         
 # pick max mem/cpu processes
 
+class TopK:
+    """Keeps the "k" rows with the largest values of column "key" among all 
+    DataFrames passed to "update". At most "k" rows are held at any time, 
+    and rows are selected with argpartition instead of a full sort.
+    TopK objects built on different nodes can be combined with "merge".
+
+    Args:
+        columns: If given, only these columns (plus "key") are kept.
+    """
+
+    def __init__(self, k, key, columns=None):
+        self.k = k
+        self.key = key
+        if columns is None:
+            self.columns = None
+        else:
+            self.columns = list(columns)
+            if key not in self.columns:
+                self.columns.append(key)
+        self.df = None
+
+    def select_largest(self, df):
+        if df.shape[0] <= self.k:
+            return df
+        # NaN is treated as the smallest value, as in sort_values
+        values = df[self.key].to_numpy(dtype=float, na_value=-np.inf)
+        if self.k == 0:
+            selector = np.zeros(0, dtype=int)
+        else:
+            selector = np.argpartition(-values, self.k - 1)[:self.k]
+        return df.iloc[np.sort(selector), :]
+
+    def update(self, df):
+        if self.columns is not None:
+            df = df.loc[:, self.columns]
+        df = self.select_largest(df)
+        if self.df is not None:
+            df = self.select_largest(pd.concat([self.df, df], axis=0))
+        self.df = df
+        return self
+
+    def merge(self, other):
+        if other.df is not None:
+            self.update(other.df)
+        return self
+
+    def result(self):
+        """Returns the kept rows sorted in descending order of "key". Empty
+        if "update" was never called.
+        """
+        if self.df is None:
+            return pd.DataFrame(columns=([self.key] if self.columns is None else self.columns))
+        return self.df.sort_values(by=self.key, axis=0, ascending=False)
+
+
 def pick_maxcpu_procs(proc_snapshot_df, n=1):
-    sorted_df = proc_snapshot_df.sort_values(by='pcpu_total', axis=0, ascending=False)
-    return sorted_df.head(n)
+    return TopK(n, 'pcpu_total').update(proc_snapshot_df).result()
 
 
 def pick_maxmem_procs(proc_snapshot_df, n=1):
-    sorted_df = proc_snapshot_df.sort_values(by='pss_GB', axis=0, ascending=False)
-    return sorted_df.head(n)
+    return TopK(n, 'pss_GB').update(proc_snapshot_df).result()
 
 
 
@@ -672,10 +1399,18 @@ def pick_maxmem_procs(proc_snapshot_df, n=1):
 # logging kill results #
 ########################
 
-def write_log(killed_procs, logdir):
+def write_log(killed_procs, logdir, summary=None):
+    """Args:
+        summary: If given, a json-serializable dict written next to the 
+            killed process table, with suffix ".summary.json".
+    """
     host_logdir = os.path.join(logdir, socket.gethostname())
     os.makedirs(host_logdir, exist_ok=True)
     logpath = os.path.join(host_logdir, datetime.datetime.now().isoformat())
     killed_procs.to_csv(logpath, sep='\t', header=True, index=False)
+    if summary is not None:
+        with open(logpath + '.summary.json', 'wt') as f:
+            json.dump(summary, f, indent=4)
+    return logpath
 
 
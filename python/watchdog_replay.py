@@ -0,0 +1,288 @@
+"""Records snapshot streams of a node and replays them through the policies
+of node_watchdog, with killing and memory readings simulated, so that
+thresholds and intervals can be compared offline.
+
+Usage:
+    python watchdog_replay.py record --out stream.bin --num-ticks 60 --interval 5
+    python watchdog_replay.py replay --stream stream.bin --params params.json
+
+params.json holds a list of dicts. Each dict may contain "policies"
+(comma-separated), "tick_interval", and keyword arguments of
+"node_watchdog.make_policies".
+"""
+
+import time
+import json
+import argparse
+import functools
+import collections
+
+import numpy as np
+import pandas as pd
+
+import utils
+import sshagent
+import psutil_funcs
+import node_watchdog
+
+
+VMem = collections.namedtuple('VMem', ['total', 'available', 'percent'])
+
+REPLAY_RESULT_COLUMNS = [
+    'num_ticks',
+    'decision_latency_mean_sec',
+    'decision_latency_max_sec',
+    'num_killed',
+    'num_incidents',
+    'num_unrecovered',
+    'recovery_mean_sec',
+    'recovery_max_sec',
+]
+
+
+def argument_parsing():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_record = subparsers.add_parser('record')
+    parser_record.add_argument(
+        '--out',
+        help=f'Path of the snapshot stream file to write.',
+        required=True,
+        dest='out',
+    )
+    parser_record.add_argument(
+        '--num-ticks',
+        help=f'The number of snapshots to record',
+        default=60,
+        type=int,
+        dest='num_ticks',
+    )
+    parser_record.add_argument(
+        '--interval',
+        help=f'Time interval (in seconds) between each snapshot',
+        default=5,
+        type=float,
+        dest='interval',
+    )
+
+    parser_replay = subparsers.add_parser('replay')
+    parser_replay.add_argument(
+        '--stream',
+        help=f'Path of a snapshot stream file written by "record".',
+        required=True,
+        dest='stream',
+    )
+    parser_replay.add_argument(
+        '--params',
+        help=f'Path of a json file with a list of parameter sets.',
+        required=True,
+        dest='params',
+    )
+    parser_replay.add_argument(
+        '--num-procs',
+        help=f'If given, each snapshot is padded with copies of its processes up to this many, to measure decision latency on large process tables. Load and memory are not changed.',
+        default=None,
+        type=int,
+        dest='num_procs',
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+#############
+# recording #
+#############
+
+def collect_frame(rate_sampler):
+    """A frame holds everything the policies read from a TickSnapshot.
+    Thread counts and PSS/USS are read for every process.
+    """
+    snapshot = node_watchdog.TickSnapshot(rate_sampler)
+    procs_df = snapshot.procs_df.copy()
+    procs_df['num_RD'] = psutil_funcs.get_thread_state_counts(procs_df['pid'].tolist())['RD']
+    psutil_funcs.add_smaps_rollup(procs_df, np.ones(procs_df.shape[0], dtype=bool))
+    vmem = snapshot.vmem
+    return {
+        'timestamp': time.time(),
+        'load': int(snapshot.load),
+        'vmem': {'total': vmem.total, 'available': vmem.available, 'percent': vmem.percent},
+        'procs_df': procs_df,
+    }
+
+
+def record(outpath, num_ticks=60, interval=5):
+    rate_sampler = psutil_funcs.RateSampler()
+    with open(outpath, 'wb') as outfile:
+        for idx in range(num_ticks):
+            sshagent.write_frame(outfile, collect_frame(rate_sampler), compress=True)
+            if idx < num_ticks - 1:
+                time.sleep(interval)
+
+
+def load_frames(path):
+    frames = list()
+    with open(path, 'rb') as infile:
+        while True:
+            try:
+                frames.append(sshagent.read_frame(infile))
+            except EOFError:
+                break
+    return frames
+
+
+def inflate_frame(frame, num_procs):
+    """Pads "procs_df" with copies of its rows, given new pids. A frame with
+    no processes is returned unchanged.
+    """
+    procs_df = frame['procs_df']
+    if (procs_df.shape[0] == 0) or (procs_df.shape[0] >= num_procs):
+        return frame
+    num_copies = -(-num_procs // procs_df.shape[0])
+    max_pid = procs_df['pid'].max()
+    copies = list()
+    for idx in range(num_copies):
+        copy = procs_df.copy()
+        copy['pid'] = copy['pid'] + idx * (max_pid + 1)
+        copies.append(copy)
+    return dict(frame, procs_df=pd.concat(copies, axis=0, ignore_index=True).iloc[:num_procs, :])
+
+
+##########
+# replay #
+##########
+
+class ReplaySnapshot(node_watchdog.TickSnapshot):
+    """A TickSnapshot built from a recorded frame. Processes killed during
+    the replay are removed; their R/D threads are subtracted from load and
+    their USS (or RSS if unknown) is added to available memory.
+    """
+
+    def __init__(self, frame, killed_pids):
+        self.frame = frame
+        self.killed_pids = frozenset(killed_pids)
+        procs_df = frame['procs_df']
+        self.is_killed = procs_df['pid'].isin(self.killed_pids).to_numpy()
+        self.recorded_df = procs_df.loc[~self.is_killed, :].set_index('pid', drop=False)
+
+    @functools.cached_property
+    def load(self):
+        killed_rd = self.frame['procs_df']['num_RD'].to_numpy()[self.is_killed].sum()
+        return max(self.frame['load'] - killed_rd, 0)
+
+    @functools.cached_property
+    def vmem(self):
+        killed_df = self.frame['procs_df'].loc[self.is_killed, :]
+        freed = killed_df['uss_bytes'].fillna(killed_df['rss_bytes']).sum()
+        total = self.frame['vmem']['total']
+        available = min(self.frame['vmem']['available'] + freed, total)
+        return VMem(total, available, round(100 * (total - available) / total, 1))
+
+    @functools.cached_property
+    def procs_df(self):
+        return self.recorded_df.loc[:, ['pid', 'rss_bytes', 'user', 'cmd', 'pcpu']].reset_index(drop=True)
+
+    def get_thread_state_counts(self, pids):
+        return {'RD': self.recorded_df['num_RD'].reindex(pids).fillna(0).to_numpy(dtype=np.int64)}
+
+    def add_smaps_rollup(self, procs_df, selected):
+        for key in ('pss_bytes', 'uss_bytes'):
+            values = self.recorded_df[key].reindex(procs_df['pid']).to_numpy(dtype=float, copy=True)
+            values[~np.asarray(selected)] = np.nan
+            procs_df[key] = values
+        procs_df['pss_GB'] = (procs_df['pss_bytes'] / 1024**3).round(3)
+        procs_df['uss_GB'] = (procs_df['uss_bytes'] / 1024**3).round(3)
+        procs_df['rss_GB'] = (procs_df['rss_bytes'] / 1024**3).round(3)
+        return procs_df
+
+
+def select_frames(frames, tick_interval=None):
+    """Picks frames at least "tick_interval" seconds apart, emulating a
+    longer monitor interval than the recording interval.
+    """
+    if tick_interval is None:
+        return list(frames)
+    selected = list()
+    for frame in frames:
+        if (len(selected) == 0) or (frame['timestamp'] - selected[-1]['timestamp'] >= tick_interval):
+            selected.append(frame)
+    return selected
+
+
+def replay(frames, params):
+    """Returns a dict with keys REPLAY_RESULT_COLUMNS.
+
+    An incident begins at a tick where any policy fires and ends at the
+    first following tick where none does; its recovery time is measured
+    with the recorded timestamps.
+    """
+    params = dict(params)
+    tick_interval = params.pop('tick_interval', None)
+    policy_names = params.pop('policies', 'memory,cpu').split(',')
+    policies = node_watchdog.make_policies(policy_names, **params)
+
+    killed_pids = set()
+
+    def kill_func(pids, timeout=None, create_times=None):
+        killed_pids.update(pids)
+        return pd.DataFrame(
+            {'pid': pids, 'status': 'exited', 'exit_sec': 0.0},
+            columns=utils.KILL_RESULT_COLUMNS,
+        )
+
+    latencies = list()
+    recoveries = list()
+    incident_start = None
+    selected = select_frames(frames, tick_interval)
+    for frame in selected:
+        overhead = node_watchdog.run_tick(
+            policies,
+            (lambda: ReplaySnapshot(frame, killed_pids)),
+            logdir=None,
+            kill_func=kill_func,
+        )
+        latencies.append(overhead['collect_wall_sec'])
+        if len(overhead['fired']) > 0:
+            if incident_start is None:
+                incident_start = frame['timestamp']
+        elif incident_start is not None:
+            recoveries.append(frame['timestamp'] - incident_start)
+            incident_start = None
+
+    return {
+        'num_ticks': len(selected),
+        'decision_latency_mean_sec': np.mean(latencies),
+        'decision_latency_max_sec': np.max(latencies),
+        'num_killed': len(killed_pids),
+        'num_incidents': len(recoveries) + (incident_start is not None),
+        'num_unrecovered': int(incident_start is not None),
+        'recovery_mean_sec': (np.mean(recoveries) if len(recoveries) > 0 else np.nan),
+        'recovery_max_sec': (np.max(recoveries) if len(recoveries) > 0 else np.nan),
+    }
+
+
+def replay_params(frames, params_list):
+    """Returns a DataFrame with one row for each parameter set"""
+    results = [replay(frames, params) for params in params_list]
+    df = pd.DataFrame.from_records(results, columns=REPLAY_RESULT_COLUMNS)
+    df.insert(0, 'params', [json.dumps(x, sort_keys=True) for x in params_list])
+    return df
+
+
+def main():
+    args = argument_parsing()
+    if args.command == 'record':
+        record(args.out, num_ticks=args.num_ticks, interval=args.interval)
+    elif args.command == 'replay':
+        frames = load_frames(args.stream)
+        if args.num_procs is not None:
+            frames = [inflate_frame(x, args.num_procs) for x in frames]
+        with open(args.params) as f:
+            params_list = json.load(f)
+        with pd.option_context('display.max_columns', None, 'display.width', None):
+            print(replay_params(frames, params_list))
+
+
+if __name__ == '__main__':
+    main()